@@ -0,0 +1,230 @@
+import asyncio
+import time
+from collections import deque
+
+from app.config import (
+    ADMISSION_CAPACITY, ADMISSION_MAX_QUEUE_COST, ADMISSION_MAX_WAIT,
+    ADMISSION_PER_HOST_LIMIT, ADMISSION_PER_CLIENT_LIMIT, ADMISSION_INTERACTIVE_MAX_COST, ADMISSION_WEIGHTS,
+)
+
+# Chi phí ước tính (đơn vị tương đối): chạy mô hình trên ảnh thu nhỏ có chi phí cố định,
+# các bước còn lại tỉ lệ với số megapixel phải xử lý
+MODEL_COST = 1.0
+COST_PER_MEGAPIXEL = 0.3
+# Chi phí nhỏ nhất của một request: chi phí âm hoặc bằng 0 sẽ làm hỏng việc tính capacity
+MIN_COST = 0.01
+
+PRIORITY_CLASSES = ["interactive", "bulk"]
+
+class AdmissionRejected(Exception):
+    """Request bị từ chối: status_code là 429 (client gửi quá nhiều) hoặc 503 (server quá tải)"""
+
+    def __init__(self, status_code, detail, retry_after=None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+def estimate_cost(width, height, id_width_px, id_height_px, border_enabled=False, border_width=0,
+                  sheet_enabled=False, sheet_rows=0, sheet_cols=0, include_model=True):
+    """Ước tính chi phí xử lý từ kích thước ảnh (đọc từ header) và các bước được bật"""
+    megapixels = width * height / 1_000_000
+    id_megapixels = id_width_px * id_height_px / 1_000_000
+    cost = (megapixels + id_megapixels) * COST_PER_MEGAPIXEL
+    if include_model:
+        cost += MODEL_COST
+
+    tile_megapixels = id_megapixels
+    if border_enabled:
+        tile_megapixels = (id_width_px + 2 * border_width) * (id_height_px + 2 * border_width) / 1_000_000
+        cost += tile_megapixels * COST_PER_MEGAPIXEL
+    if sheet_enabled:
+        cost += sheet_rows * sheet_cols * tile_megapixels * COST_PER_MEGAPIXEL
+    return max(cost, MIN_COST)
+
+def classify(cost, requested_priority=None):
+    """Request nhỏ được ưu tiên; client chỉ có thể tự hạ mức ưu tiên xuống bulk"""
+    if requested_priority == "bulk" or cost > ADMISSION_INTERACTIVE_MAX_COST:
+        return "bulk"
+    return "interactive"
+
+class Ticket:
+    def __init__(self, host, client_id, cost, priority):
+        self.host = host
+        # Khóa phụ trong phạm vi một địa chỉ IP: X-Client-Id do client tự đặt nên không dùng riêng
+        self.client_key = (host, client_id)
+        self.cost = cost
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.future = None
+
+class AdmissionController:
+    """
+    Điều phối request theo chi phí:
+    - Tổng chi phí đang xử lý không vượt quá capacity
+    - Request chờ trong các hàng đợi theo mức ưu tiên, được lấy ra theo trọng số
+    - Mỗi địa chỉ IP và mỗi client (IP + X-Client-Id) bị giới hạn số request đang xử lý
+      và đang chờ (429); đổi X-Client-Id không vượt được giới hạn theo IP
+    - Hàng đợi quá đầy hoặc chờ quá lâu thì từ chối (503)
+    """
+
+    def __init__(self, capacity=ADMISSION_CAPACITY, max_queue_cost=ADMISSION_MAX_QUEUE_COST,
+                 max_wait=ADMISSION_MAX_WAIT, per_host_limit=ADMISSION_PER_HOST_LIMIT,
+                 per_client_limit=ADMISSION_PER_CLIENT_LIMIT, weights=ADMISSION_WEIGHTS):
+        self.capacity = capacity
+        self.max_queue_cost = max_queue_cost
+        self.max_wait = max_wait
+        self.per_host_limit = per_host_limit
+        self.per_client_limit = per_client_limit
+        self.weights = weights
+
+        self.queues = {priority: deque() for priority in PRIORITY_CLASSES}
+        self.credits = dict(weights)
+        self.in_flight_cost = 0.0
+        self.queued_cost = 0.0
+        self.host_counts = {}
+        self.client_counts = {}
+
+        self.counters = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_client_limit": 0,
+            "rejected_overload": 0,
+            "rejected_timeout": 0,
+            "completed": 0,
+        }
+        self.admitted_by_priority = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.total_wait = 0.0
+
+    async def acquire(self, host, cost, priority="interactive", client_id=None):
+        """
+        Chờ đến lượt xử lý, trả về ticket cần truyền cho release().
+        host: địa chỉ IP của kết nối; client_id: X-Client-Id (tùy chọn) để phân biệt các client sau cùng một IP.
+        """
+        ticket = Ticket(host, client_id, cost, priority)
+        if (self.host_counts.get(host, 0) >= self.per_host_limit
+                or self.client_counts.get(ticket.client_key, 0) >= self.per_client_limit):
+            self.counters["rejected_client_limit"] += 1
+            raise AdmissionRejected(429, "Quá nhiều request đồng thời từ client này", retry_after=1)
+
+        queues_empty = not any(self.queues.values())
+        if queues_empty and self._fits(cost):
+            self._start(ticket)
+            return ticket
+
+        if self.queued_cost + cost > self.max_queue_cost:
+            self.counters["rejected_overload"] += 1
+            raise AdmissionRejected(503, "Server đang quá tải, vui lòng thử lại sau",
+                                    retry_after=self._retry_after())
+
+        ticket.future = asyncio.get_running_loop().create_future()
+        self.queues[priority].append(ticket)
+        self.queued_cost += cost
+        self._increment_client(ticket)
+        self.counters["queued"] += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if ticket.future.done():
+                # Được cấp quyền đúng lúc hết thời gian chờ
+                return ticket
+            self._remove_waiting(ticket)
+            self.counters["rejected_timeout"] += 1
+            raise AdmissionRejected(503, "Hết thời gian chờ xử lý, vui lòng thử lại sau",
+                                    retry_after=self._retry_after())
+        except asyncio.CancelledError:
+            # Client ngắt kết nối khi đang chờ
+            if ticket.future.done():
+                self.release(ticket)
+            else:
+                self._remove_waiting(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket):
+        """Kết thúc xử lý một request và cấp quyền cho các request đang chờ"""
+        self.in_flight_cost -= ticket.cost
+        self._decrement_client(ticket)
+        self.counters["completed"] += 1
+        self._dispatch()
+
+    def queue_length(self):
+        """Số request đang chờ trong tất cả các hàng đợi"""
+        return sum(len(queue) for queue in self.queues.values())
+
+    def metrics(self):
+        admitted = self.counters["admitted"]
+        return {
+            **self.counters,
+            "admitted_by_priority": dict(self.admitted_by_priority),
+            "in_flight_cost": round(self.in_flight_cost, 2),
+            "queued_cost": round(self.queued_cost, 2),
+            "queue_depth": {priority: len(queue) for priority, queue in self.queues.items()},
+            "capacity": self.capacity,
+            "average_wait_seconds": round(self.total_wait / admitted, 3) if admitted else 0.0,
+        }
+
+    def _fits(self, cost):
+        # Request lớn hơn toàn bộ capacity vẫn được chạy khi server rảnh
+        return self.in_flight_cost < 1e-9 or self.in_flight_cost + cost <= self.capacity
+
+    def _start(self, ticket):
+        self.in_flight_cost += ticket.cost
+        if ticket.future is None:
+            self._increment_client(ticket)
+        self.counters["admitted"] += 1
+        self.admitted_by_priority[ticket.priority] += 1
+        self.total_wait += time.monotonic() - ticket.enqueued_at
+
+    def _next_priority(self):
+        """Round-robin theo trọng số giữa các hàng đợi không rỗng"""
+        candidates = [priority for priority in PRIORITY_CLASSES if self.queues[priority]]
+        if not candidates:
+            return None
+        if all(self.credits[priority] <= 0 for priority in candidates):
+            for priority in PRIORITY_CLASSES:
+                self.credits[priority] = self.weights[priority]
+        return max(candidates, key=lambda priority: self.credits[priority])
+
+    def _dispatch(self):
+        while True:
+            priority = self._next_priority()
+            if priority is None:
+                return
+            ticket = self.queues[priority][0]
+            if not self._fits(ticket.cost):
+                # Giữ thứ tự để request lớn không bị bỏ đói
+                return
+            self.queues[priority].popleft()
+            self.queued_cost -= ticket.cost
+            self.credits[priority] -= 1
+            self._start(ticket)
+            ticket.future.set_result(True)
+
+    def _remove_waiting(self, ticket):
+        try:
+            self.queues[ticket.priority].remove(ticket)
+        except ValueError:
+            return
+        self.queued_cost -= ticket.cost
+        self._decrement_client(ticket)
+
+    def _increment_client(self, ticket):
+        self.host_counts[ticket.host] = self.host_counts.get(ticket.host, 0) + 1
+        self.client_counts[ticket.client_key] = self.client_counts.get(ticket.client_key, 0) + 1
+
+    def _decrement_client(self, ticket):
+        for counts, key in ((self.host_counts, ticket.host), (self.client_counts, ticket.client_key)):
+            count = counts.get(key, 0) - 1
+            if count > 0:
+                counts[key] = count
+            else:
+                counts.pop(key, None)
+
+    def _retry_after(self):
+        # Ước lượng thô: mỗi đơn vị chi phí mất khoảng một giây
+        return max(1, int((self.queued_cost + self.in_flight_cost) / max(self.capacity, 1)))
+
+# Bộ điều phối dùng chung cho tiến trình
+admission = AdmissionController()
@@ -0,0 +1,286 @@
+"""
+Công cụ đo hiệu năng.
+
+Ví dụ:
+    python -m app.bench imports            # Thời gian import khi khởi động tiến trình
+    python -m app.bench soak --requests 2000  # Kiểm tra rò rỉ bộ nhớ khi xử lý liên tục qua API
+    python -m app.bench compositing        # So sánh ghép ảnh/viền bằng PIL và NumPy
+"""
+import argparse
+import contextlib
+import gc
+import os
+import subprocess
+import sys
+import time
+
+# Các thư viện nặng không được tải khi chỉ import ứng dụng
+HEAVY_MODULES = ["torch", "transformers", "cv2", "numpy"]
+
+def run_python(code, *flags):
+    """Chạy đoạn code trong một tiến trình Python mới, trả về (stdout, stderr, thời gian)"""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        capture_output=True, text=True, check=True,
+    )
+    return result.stdout, result.stderr, time.perf_counter() - started
+
+def parse_importtime(stderr):
+    """Đọc kết quả của -X importtime, trả về {module: thời gian tích lũy (giây)}"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        timings[name.strip()] = int(cumulative_us) / 1_000_000
+    return timings
+
+def bench_imports(args):
+    """Báo cáo thời gian import app.main và kiểm tra các thư viện nặng không bị tải"""
+    code = (
+        f"import sys, {args.module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    stdout, stderr, wall = run_python(code, "-X", "importtime")
+    timings = parse_importtime(stderr)
+    loaded = [m for m in stdout.strip().split(",") if m]
+
+    print(f"Import {args.module}: {wall:.3f}s (bao gồm khởi động trình thông dịch)")
+    print(f"Top {args.top} module theo thời gian tích lũy:")
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {seconds * 1000:9.1f} ms  {name}")
+
+    if loaded:
+        print(f"Các thư viện nặng đã bị tải khi import: {', '.join(loaded)}")
+        return 1
+    print("Không thư viện nặng nào được tải khi import")
+
+    # So sánh với thời gian import riêng từng thư viện nặng
+    print("Thời gian import riêng từng thư viện nặng:")
+    for name in HEAVY_MODULES:
+        try:
+            _, _, seconds = run_python(f"import {name}")
+        except subprocess.CalledProcessError:
+            print(f"  {name}: chưa được cài đặt")
+            continue
+        print(f"  {name}: {seconds:.3f}s")
+    return 0
+
+# Các URL trong kết quả /upload được tải về (và xóa sau mỗi request) trong bài kiểm tra soak
+SOAK_RESULT_URLS = ["id_photo_url", "removed_bg_url", "id_photo_with_border_url", "photo_sheet_url"]
+
+def ellipse_mask(size):
+    """Mask tổng hợp: hình elip ở giữa ảnh"""
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    mask = Image.new("L", size, 0)
+    ImageDraw.Draw(mask).ellipse((width // 4, height // 8, width * 3 // 4, height * 7 // 8), fill=255)
+    return mask
+
+def stub_model(img, model_input_size=None, return_mask=True):
+    """Thay cho pipeline RMBG-1.4: trả về mask elip, nhận cùng tham số như mô hình thật"""
+    return ellipse_mask(img.size)
+
+def make_soak_image(width, height):
+    """Ảnh JPEG tổng hợp (dạng bytes) để upload"""
+    import io
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", (width, height), (180, 140, 120))
+    ImageDraw.Draw(img).ellipse((width // 3, height // 5, width * 2 // 3, height // 2), fill=(225, 190, 160))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def remove_soak_outputs(result):
+    """Xóa các file do một request tạo ra để thư mục static không phình to trong bài kiểm tra"""
+    from app.config import STATIC_DIR, UPLOADS_DIR, RESULTS_DIR
+    from app.utils import get_mask_filename
+
+    filename = os.path.basename(result["original_url"])
+    paths = [os.path.join(UPLOADS_DIR, filename), os.path.join(RESULTS_DIR, get_mask_filename(filename))]
+    for key in SOAK_RESULT_URLS:
+        url = result.get(key)
+        if url:
+            paths.append(os.path.join(STATIC_DIR, url[len("/static/"):]))
+    for path in paths:
+        for candidate in (path, path + ".gz"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(candidate)
+
+def bench_soak(args):
+    """
+    Gửi lặp lại request POST /api/photo/upload (kèm viền và sheet) qua ứng dụng ASGI, tải các
+    file kết quả (ảnh thẻ, ảnh nobg_* được dựng lại, viền, sheet) và theo dõi RSS.
+    Mặc định mô hình được thay bằng mask elip; --real-model dùng RMBG-1.4.
+    RSS phải đi ngang sau giai đoạn khởi động: nếu nửa sau còn tăng quá ngưỡng thì coi là rò rỉ.
+    """
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError as e:
+        print(f"Cần cài đặt httpx để chạy bài kiểm tra soak qua ứng dụng ({e})")
+        return 1
+    from app import image_processing
+    from app.config import BASE_DIR
+    from app.profiling import rss_bytes, MB
+
+    # Ứng dụng ghi file theo đường dẫn tương đối "static/..." như khi chạy uvicorn
+    os.chdir(BASE_DIR)
+    if not args.real_model:
+        image_processing.get_model = lambda: stub_model
+    from app.main import app
+
+    image = make_soak_image(args.width, args.height)
+    form = {
+        "size": args.size,
+        "border_enabled": "true",
+        "sheet_enabled": "true",
+        "sheet_rows": "2",
+        "sheet_cols": "3",
+    }
+
+    samples = []
+    started = time.perf_counter()
+    # Bỏ qua log của từng bước (không dùng StringIO vì chính nó sẽ làm tăng bộ nhớ)
+    with TestClient(app) as client, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for index in range(1, args.requests + 1):
+            response = client.post("/api/photo/upload", data=form,
+                                   files={"file": ("soak.jpg", image, "image/jpeg")})
+            if response.status_code != 200:
+                print(f"Request {index} lỗi {response.status_code}: {response.text}", file=sys.stderr)
+                return 1
+            result = response.json()
+            for key in SOAK_RESULT_URLS:
+                url = result.get(key)
+                if url and client.get(url).status_code != 200:
+                    print(f"Request {index}: không tải được {url}", file=sys.stderr)
+                    return 1
+            remove_soak_outputs(result)
+            if index % args.sample_every == 0:
+                gc.collect()
+                samples.append((index, rss_bytes()))
+    elapsed = time.perf_counter() - started
+
+    if len(samples) < 4:
+        print("Quá ít mẫu, hãy tăng --requests hoặc giảm --sample-every")
+        return 1
+
+    print(f"Đã xử lý {args.requests} request trong {elapsed:.1f}s ({args.requests / elapsed:.1f} request/giây)")
+    for index, rss in samples[::max(1, len(samples) // 10)]:
+        print(f"  sau {index:6d} request: RSS {rss / MB:8.1f} MB")
+
+    # So sánh RSS ở giữa và cuối bài kiểm tra
+    middle_rss = samples[len(samples) // 2][1]
+    final_rss = samples[-1][1]
+    growth_mb = (final_rss - middle_rss) / MB
+    print(f"RSS tăng {growth_mb:.1f} MB trong nửa sau (ngưỡng: {args.max_growth_mb} MB)")
+    if growth_mb > args.max_growth_mb:
+        print("RSS không ổn định, có thể đang rò rỉ bộ nhớ")
+        return 1
+    print("RSS ổn định")
+    return 0
+
+def compose_pil(img, bg_color, border_width, border_color):
+    """Cách ghép cũ bằng PIL: Image.new + paste cho nền, rồi Image.new + paste cho viền"""
+    from PIL import Image
+
+    background = Image.new('RGBA', img.size, bg_color + (255,))
+    background.paste(img, (0, 0), img)
+    width, height = background.size
+    bordered = Image.new('RGBA', (width + 2 * border_width, height + 2 * border_width), border_color + (255,))
+    bordered.paste(background, (border_width, border_width), background)
+    return bordered
+
+def time_per_call(func, repeat):
+    """Thời gian trung bình mỗi lần gọi (mili giây), sau một lần chạy khởi động"""
+    func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+def bench_compositing(args):
+    """So sánh ghép nền + viền bằng PIL với nhân NumPy (trả ảnh PIL và ghi thẳng vào bộ đệm có sẵn)"""
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFilter
+    from app.compositing import BufferPool, composite, composite_image
+    from app.utils import get_size_px
+
+    width, height = get_size_px(args.size, args.dpi)
+    bg_color, border_color, border_width = (255, 255, 255), (0, 0, 0), args.border_width
+
+    # Ảnh RGBA tổng hợp: nhiễu màu và mask elip có viền mềm như ảnh đã xóa phông
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+    alpha = Image.new("L", (width, height), 0)
+    ImageDraw.Draw(alpha).ellipse((width // 6, height // 10, width * 5 // 6, height), fill=255)
+    img.putalpha(alpha.filter(ImageFilter.GaussianBlur(4)))
+    planes = [np.asarray(band) for band in img.split()]
+
+    pool = BufferPool()
+    out = np.empty((3, height + 2 * border_width, width + 2 * border_width), dtype=np.uint8)
+
+    results = {
+        "PIL (Image.new + paste)": time_per_call(
+            lambda: compose_pil(img, bg_color, border_width, border_color), args.repeat),
+        "NumPy (ảnh PIL, bộ đệm từ pool)": time_per_call(
+            lambda: composite_image(img, bg_color, border_width, border_color, pool=pool), args.repeat),
+        "NumPy (ghi thẳng vào bộ đệm có sẵn)": time_per_call(
+            lambda: composite(planes, bg_color, border_width, border_color, out=out, pool=pool), args.repeat),
+    }
+
+    print(f"Ảnh {args.size} ở {args.dpi} DPI: {width}x{height}px, viền {border_width}px, {args.repeat} lần")
+    baseline = results["PIL (Image.new + paste)"]
+    for name, ms in results.items():
+        print(f"  {name:40s} {ms:8.2f} ms/ảnh  (x{baseline / ms:.2f})")
+
+    # So sánh với PIL khi ảnh nền đã là RGB: cách cũ để lại alpha < 255 ở viền mềm
+    # của ảnh thẻ, khiến bước thêm viền trộn thêm màu viền vào các pixel đó
+    reference = Image.new("RGBA", img.size, bg_color + (255,))
+    reference.paste(img, (0, 0), img)
+    reference = reference.convert("RGB")
+    bordered = Image.new("RGB", (reference.width + 2 * border_width, reference.height + 2 * border_width), border_color)
+    bordered.paste(reference, (border_width, border_width))
+    result = np.asarray(Image.merge("RGB", [Image.fromarray(plane) for plane in out]))
+    max_diff = int(np.abs(np.asarray(bordered).astype(np.int16) - result.astype(np.int16)).max())
+    print(f"Sai khác tối đa so với PIL: {max_diff}")
+    print(f"Bộ đệm: {pool.metrics()}")
+    return 1 if max_diff > 1 else 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m app.bench", description="Đo hiệu năng ứng dụng")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    imports = subparsers.add_parser("imports", help="Thời gian import khi khởi động")
+    imports.add_argument("--module", default="app.main", help="Module cần đo (mặc định: app.main)")
+    imports.add_argument("--top", type=int, default=15, help="Số module hiển thị")
+    imports.set_defaults(func=bench_imports)
+
+    soak = subparsers.add_parser("soak", help="Chạy lặp lại để phát hiện rò rỉ bộ nhớ")
+    soak.add_argument("--requests", type=int, default=2000, help="Số request giả lập")
+    soak.add_argument("--size", default="3x4", help="Kích thước ảnh thẻ")
+    soak.add_argument("--width", type=int, default=1200, help="Chiều rộng ảnh gốc tổng hợp")
+    soak.add_argument("--height", type=int, default=1600, help="Chiều cao ảnh gốc tổng hợp")
+    soak.add_argument("--sample-every", type=int, default=50, help="Số request giữa hai lần đo RSS")
+    soak.add_argument("--real-model", action="store_true", help="Dùng mô hình RMBG-1.4 thay cho mask tổng hợp")
+    soak.add_argument("--max-growth-mb", type=float, default=20.0,
+                      help="Mức tăng RSS tối đa cho phép trong nửa sau")
+    soak.set_defaults(func=bench_soak)
+
+    compositing = subparsers.add_parser("compositing", help="So sánh ghép ảnh/viền bằng PIL và NumPy")
+    compositing.add_argument("--size", default="3x4", help="Kích thước ảnh thẻ")
+    compositing.add_argument("--dpi", type=int, default=300, help="Độ phân giải (mặc định: 300)")
+    compositing.add_argument("--border-width", type=int, default=2)
+    compositing.add_argument("--repeat", type=int, default=200, help="Số lần lặp")
+    compositing.set_defaults(func=bench_compositing)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
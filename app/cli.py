@@ -0,0 +1,203 @@
+"""
+Xử lý hàng loạt ảnh thẻ từ dòng lệnh, không cần đi qua HTTP.
+
+Ví dụ:
+    python -m app.cli input_dir output_dir --size 3x4 --border --sheet --workers 8
+
+Tiến trình được ghi vào file manifest (mặc định: output_dir/manifest.jsonl),
+khi chạy lại với cùng thư mục đầu ra, các ảnh đã xử lý xong sẽ được bỏ qua.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app.utils import parse_color
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+MANIFEST_NAME = "manifest.jsonl"
+
+def find_images(input_dir, exclude_dir=None):
+    """
+    Liệt kê các file ảnh trong thư mục đầu vào (đường dẫn tương đối, đã sắp xếp).
+    exclude_dir: bỏ qua thư mục này (thư mục đầu ra nằm trong thư mục đầu vào,
+    tránh lấy chính ảnh kết quả làm ảnh đầu vào khi chạy lại).
+    """
+    excluded = os.path.realpath(exclude_dir) if exclude_dir else None
+    images = []
+    for root, dirs, files in os.walk(input_dir):
+        if excluded is not None:
+            dirs[:] = [name for name in dirs if os.path.realpath(os.path.join(root, name)) != excluded]
+        for name in files:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                images.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(images)
+
+def load_manifest(manifest_path):
+    """Đọc manifest và trả về tập các ảnh đã xử lý thành công"""
+    done = set()
+    if not os.path.exists(manifest_path):
+        return done
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Dòng cuối có thể bị ghi dở khi tiến trình bị dừng đột ngột
+                continue
+            if entry.get("status") == "done":
+                done.add(entry["input"])
+    return done
+
+def init_worker(threads_per_worker):
+    """Khởi tạo tiến trình con: giới hạn số luồng của torch và tải mô hình một lần"""
+    import torch
+    from app.image_processing import get_model
+
+    torch.set_num_threads(threads_per_worker)
+    get_model()
+
+def process_image(input_dir, output_dir, relative_path, options):
+    """Chạy toàn bộ luồng xử lý cho một ảnh, trả về bản ghi cho manifest"""
+    from app.image_processing import remove_background, create_id_photo
+    from app.image_utils import create_photo_sheet
+
+    started = time.perf_counter()
+    input_path = os.path.join(input_dir, relative_path)
+    target_dir = os.path.join(output_dir, os.path.dirname(relative_path))
+    # Giữ phần mở rộng trong tên đầu ra để a.jpg và a.png không ghi đè lên nhau
+    name = os.path.basename(relative_path)
+    os.makedirs(target_dir, exist_ok=True)
+
+    outputs = {
+        "removed_bg": os.path.join(target_dir, f"nobg_{name}.png"),
+        "id_photo": os.path.join(target_dir, f"idphoto_{name}.png"),
+    }
+
+    try:
+        remove_background(input_path, outputs["removed_bg"], options["min_tier"])
+        sheet_input_path = outputs["id_photo"]
+        if options["border_enabled"]:
+            outputs["border"] = os.path.join(target_dir, f"border_{name}.png")
+            sheet_input_path = outputs["border"]
+
+        # Các hàm xử lý mặc định ghi ảnh trống/bản sao khi lỗi, ở đây cần báo lỗi để manifest ghi "failed".
+        # Ảnh có viền (nếu bật) được ghép cùng lúc với ảnh thẻ
+        create_id_photo(outputs["removed_bg"], outputs["id_photo"], options["size"], options["bg_color"],
+                        raise_errors=True, border_path=outputs.get("border"),
+                        border_width=options["border_width"], border_color=options["border_color"])
+
+        if options["sheet_enabled"]:
+            outputs["sheet"] = os.path.join(target_dir, f"sheet_{name}.png")
+            create_photo_sheet(sheet_input_path, outputs["sheet"], options["sheet_rows"], options["sheet_cols"],
+                               options["sheet_spacing"], options["bg_color"], raise_errors=True)
+
+        status, error = "done", None
+    except Exception as e:
+        status, error = "failed", str(e)
+
+    return {
+        "input": relative_path,
+        "status": status,
+        "error": error,
+        "outputs": {key: os.path.relpath(path, output_dir) for key, path in outputs.items()},
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="Tạo ảnh thẻ hàng loạt từ một thư mục ảnh")
+    parser.add_argument("input_dir", help="Thư mục chứa ảnh gốc")
+    parser.add_argument("output_dir", help="Thư mục lưu kết quả")
+    parser.add_argument("--size", default="3x4", help="Kích thước ảnh thẻ (mặc định: 3x4)")
+    parser.add_argument("--bg-color", default="255,255,255", help="Màu nền R,G,B")
+    parser.add_argument("--border", dest="border_enabled", action="store_true", help="Thêm viền cho ảnh thẻ")
+    parser.add_argument("--border-width", type=int, default=2)
+    parser.add_argument("--border-color", default="0,0,0", help="Màu viền R,G,B")
+    parser.add_argument("--sheet", dest="sheet_enabled", action="store_true", help="Tạo sheet ảnh thẻ")
+    parser.add_argument("--sheet-rows", type=int, default=4)
+    parser.add_argument("--sheet-cols", type=int, default=6)
+    parser.add_argument("--sheet-spacing", type=int, default=10)
+    parser.add_argument("--min-tier", default="full", choices=["full", "reduced", "lite"],
+                        help="Mức mô hình tối thiểu (mặc định: full, không tự hạ chất lượng)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Số tiến trình xử lý song song (mặc định: số nhân CPU)")
+    parser.add_argument("--manifest", default=None, help="Đường dẫn file manifest (mặc định: output_dir/manifest.jsonl)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if not os.path.isdir(args.input_dir):
+        print(f"Thư mục đầu vào không tồn tại: {args.input_dir}")
+        return 1
+    if os.path.realpath(args.output_dir) == os.path.realpath(args.input_dir):
+        print("Thư mục đầu ra phải khác thư mục đầu vào")
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    options = {
+        "size": args.size,
+        "bg_color": parse_color(args.bg_color, (255, 255, 255)),
+        "border_enabled": args.border_enabled,
+        "border_width": args.border_width,
+        "border_color": parse_color(args.border_color, (0, 0, 0)),
+        "sheet_enabled": args.sheet_enabled,
+        "sheet_rows": args.sheet_rows,
+        "sheet_cols": args.sheet_cols,
+        "sheet_spacing": args.sheet_spacing,
+        "min_tier": args.min_tier,
+    }
+
+    manifest_path = args.manifest or os.path.join(args.output_dir, MANIFEST_NAME)
+    done = load_manifest(manifest_path)
+    pending = [path for path in find_images(args.input_dir, args.output_dir) if path not in done]
+    total = len(pending)
+    print(f"Tìm thấy {total + len(done)} ảnh, {len(done)} ảnh đã xử lý trước đó, còn lại {total} ảnh")
+    if total == 0:
+        return 0
+
+    workers = max(1, min(args.workers, total))
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    completed = 0
+    failed = 0
+    started = time.perf_counter()
+
+    with open(manifest_path, "a", encoding="utf-8") as manifest, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads_per_worker,)) as executor:
+        futures = [
+            executor.submit(process_image, args.input_dir, args.output_dir, path, options)
+            for path in pending
+        ]
+        for future in as_completed(futures):
+            entry = future.result()
+            # Ghi ngay từng dòng để có thể tiếp tục nếu bị dừng giữa chừng
+            manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            manifest.flush()
+
+            completed += 1
+            if entry["status"] != "done":
+                failed += 1
+                print(f"Lỗi khi xử lý {entry['input']}: {entry['error']}")
+
+            elapsed = time.perf_counter() - started
+            throughput = completed / elapsed if elapsed > 0 else 0.0
+            eta = (total - completed) / throughput if throughput > 0 else 0.0
+            print(f"[{completed}/{total}] {throughput:.2f} ảnh/giây, còn lại khoảng {format_eta(eta)}")
+
+    print(f"Hoàn tất: {completed - failed} thành công, {failed} lỗi, "
+          f"tổng thời gian {format_eta(time.perf_counter() - started)}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Ghép ảnh bằng NumPy trên bộ đệm uint8: trộn alpha lên màu nền và vẽ viền trong
+một lần ghi vào bộ đệm đầu ra đã cấp phát sẵn, thay cho Image.new + paste của PIL.
+
+numpy chỉ được import bên trong hàm để không làm chậm khởi động ứng dụng.
+"""
+import threading
+from collections import OrderedDict
+
+from app.config import COMPOSITING_POOL_MB
+
+class BufferPool:
+    """
+    Giữ lại các bộ đệm NumPy đã dùng để tái sử dụng cho các ảnh cùng kích thước
+    (ảnh thẻ có ít kích thước cố định nên tỉ lệ dùng lại cao).
+    Tổng dung lượng giữ lại bị giới hạn bởi max_bytes: kích thước ảnh phụ thuộc vào client
+    (border_width, ảnh đầu vào của /add-border), nên các kích thước ít dùng nhất bị loại trước (LRU).
+    """
+
+    def __init__(self, max_per_shape=4, max_bytes=COMPOSITING_POOL_MB * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.max_per_shape = max_per_shape
+        self.max_bytes = max_bytes
+        self.free = OrderedDict()
+        self.pooled_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0}
+
+    def acquire(self, shape, dtype="uint8"):
+        import numpy as np
+
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            buffers = self.free.get(key)
+            if buffers:
+                self.stats["hits"] += 1
+                buffer = buffers.pop()
+                self.pooled_bytes -= buffer.nbytes
+                if not buffers:
+                    del self.free[key]
+                return buffer
+            self.stats["misses"] += 1
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, *buffers):
+        with self.lock:
+            for buffer in buffers:
+                if buffer.nbytes > self.max_bytes:
+                    continue
+                key = (buffer.shape, buffer.dtype.str)
+                free = self.free.setdefault(key, [])
+                # Kích thước vừa dùng được đưa về cuối (bị loại sau cùng)
+                self.free.move_to_end(key)
+                if len(free) < self.max_per_shape:
+                    free.append(buffer)
+                    self.pooled_bytes += buffer.nbytes
+            self._evict()
+
+    def _evict(self):
+        """Bỏ bộ đệm của các kích thước ít dùng nhất cho đến khi tổng dung lượng nằm trong giới hạn"""
+        while self.pooled_bytes > self.max_bytes and self.free:
+            key, free = next(iter(self.free.items()))
+            self.pooled_bytes -= free.pop().nbytes
+            self.stats["evicted"] += 1
+            if not free:
+                del self.free[key]
+
+    def metrics(self):
+        with self.lock:
+            return {
+                **self.stats,
+                "pooled_buffers": sum(len(buffers) for buffers in self.free.values()),
+                "pooled_shapes": len(self.free),
+                "pooled_mb": round(self.pooled_bytes / (1024 * 1024), 2),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+            }
+
+# Bộ đệm dùng chung cho tiến trình
+buffer_pool = BufferPool()
+
+def composite(planes, bg_color=(255, 255, 255), border_width=0, border_color=(0, 0, 0), out=None, pool=buffer_pool):
+    """
+    Trộn ảnh lên màu nền và thêm viền.
+    planes: các kênh R, G, B (và A nếu có), mỗi kênh là mảng HxW uint8.
+    Kết quả được ghi vào out dạng từng kênh (3 x (H + 2*border) x (W + 2*border), uint8),
+    mỗi pixel của out chỉ được ghi một lần. Nếu out là None, bộ đệm được lấy từ pool
+    và người gọi phải trả lại bằng pool.release(out) sau khi dùng xong.
+
+    Tính theo từng kênh liên tục trong bộ nhớ: NumPy xử lý chậm khi broadcast trên
+    trục cuối có 3-4 phần tử (RGB/RGBA xen kẽ).
+    """
+    import numpy as np
+
+    height, width = planes[0].shape
+    b = border_width
+    shape = (3, height + 2 * b, width + 2 * b)
+    if out is None:
+        out = pool.acquire(shape)
+    elif out.shape != shape or out.dtype != np.uint8:
+        raise ValueError(f"Bộ đệm đầu ra phải có kích thước {shape} kiểu uint8")
+
+    has_alpha = len(planes) == 4
+    if has_alpha:
+        alpha = pool.acquire((height, width), np.uint16)
+        scratch = pool.acquire((height, width), np.uint16)
+        carry = pool.acquire((height, width), np.uint16)
+        np.copyto(alpha, planes[3])
+
+    try:
+        for channel in range(3):
+            plane = out[channel]
+            # Viền: chỉ ghi 4 dải quanh mép, không tô toàn bộ ảnh
+            if b > 0:
+                plane[:b] = border_color[channel]
+                plane[-b:] = border_color[channel]
+                plane[b:-b, :b] = border_color[channel]
+                plane[b:-b, -b:] = border_color[channel]
+            inner = plane[b:b + height, b:b + width]
+
+            if not has_alpha:
+                inner[...] = planes[channel]
+                continue
+
+            # out = (fg * a + bg * (255 - a)) / 255 = (a * (fg - bg) + 255 * bg) / 255
+            # Tính trên uint16: phép trừ có thể tràn nhưng kết quả cuối nằm trong [0, 65025]
+            # nên số học modulo 2^16 vẫn cho giá trị đúng
+            bg = bg_color[channel]
+            np.copyto(scratch, planes[channel])
+            np.subtract(scratch, bg, out=scratch)
+            np.multiply(scratch, alpha, out=scratch)
+            np.add(scratch, bg * 255 + 128, out=scratch)
+            # Chia cho 255 có làm tròn: (t + (t >> 8)) >> 8
+            np.right_shift(scratch, 8, out=carry)
+            np.add(scratch, carry, out=scratch)
+            np.right_shift(scratch, 8, out=scratch)
+            np.copyto(inner, scratch, casting="unsafe")
+    finally:
+        if has_alpha:
+            pool.release(alpha, scratch, carry)
+    return out
+
+def composite_image(img, bg_color=(255, 255, 255), border_width=0, border_color=(0, 0, 0), pool=buffer_pool):
+    """Như composite() nhưng nhận và trả về ảnh PIL (RGB)"""
+    import numpy as np
+    from PIL import Image
+
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
+    # PIL tách/gộp kênh nhanh hơn nhiều so với đảo trục trong NumPy
+    planes = [np.asarray(band) for band in img.split()]
+    out = composite(planes, bg_color, border_width, border_color, pool=pool)
+    try:
+        # Image.merge sao chép dữ liệu nên có thể trả bộ đệm về pool ngay
+        return Image.merge("RGB", [Image.fromarray(plane) for plane in out])
+    finally:
+        pool.release(out)
+
+def composite_with_border(img, bg_color=(255, 255, 255), border_width=0, border_color=(0, 0, 0), pool=buffer_pool):
+    """
+    Trộn ảnh lên màu nền và thêm viền trong một lần ghép, trả về (ảnh không viền, ảnh có viền) dạng RGB.
+    Ảnh không viền là phần bên trong của ảnh có viền, không cần ghép hay giải mã lại.
+    """
+    bordered = composite_image(img, bg_color, border_width, border_color, pool=pool)
+    b = border_width
+    return bordered.crop((b, b, bordered.width - b, bordered.height - b)), bordered
@@ -9,9 +9,17 @@ STATIC_DIR = os.path.join(BASE_DIR, "static")
 UPLOADS_DIR = os.path.join(STATIC_DIR, "uploads")
 RESULTS_DIR = os.path.join(STATIC_DIR, "results")
 
+# Thư mục lưu trạng thái xem trước chờ finalize (không public)
+SESSIONS_DIR = os.path.join(BASE_DIR, "sessions")
+
 # Đảm bảo các thư mục tồn tại
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 os.makedirs(RESULTS_DIR, exist_ok=True)
+os.makedirs(SESSIONS_DIR, exist_ok=True)
+
+# Cache HTTP cho file tĩnh: tên file kết quả là UUID nên nội dung không bao giờ thay đổi
+STATIC_CACHE_MAX_AGE = int(os.getenv("STATIC_CACHE_MAX_AGE", "31536000"))  # 1 năm
+STATIC_PRECOMPRESS = os.getenv("STATIC_PRECOMPRESS", "0") == "1"  # Tạo sẵn bản nén .gz cho file kết quả
 
 # DPI tiêu chuẩn cho ảnh in
 DPI = 600
@@ -22,4 +30,56 @@ CORS_ORIGINS = ["*"]  # Trong môi trường production, hãy giới hạn ngu
 # Thông tin ứng dụng
 APP_NAME = "Ứng dụng Tạo Ảnh Thẻ API"
 APP_DESCRIPTION = "API cho ứng dụng tạo ảnh thẻ với chức năng xóa phông nền"
-APP_VERSION = "1.0.0"
\ No newline at end of file
+APP_VERSION = "1.0.0"
+
+# Cấu hình chế độ xem trước trực tiếp qua WebSocket
+LIVE_MAX_SIDE = int(os.getenv("LIVE_MAX_SIDE", "320"))  # Cạnh dài tối đa của khung hình đưa vào mô hình
+LIVE_TARGET_FPS = float(os.getenv("LIVE_TARGET_FPS", "10"))  # Tốc độ khung hình trả về mục tiêu
+LIVE_DIFF_THRESHOLD = float(os.getenv("LIVE_DIFF_THRESHOLD", "6.0"))  # Độ chênh lệch trung bình (0-255) để dùng lại mask cũ
+LIVE_JPEG_QUALITY = int(os.getenv("LIVE_JPEG_QUALITY", "70"))
+# Kích thước đầu vào của mô hình cho khung hình trực tiếp (mô hình mặc định phóng mọi ảnh lên 1024x1024)
+LIVE_MODEL_INPUT_SIZE = int(os.getenv("LIVE_MODEL_INPUT_SIZE", str(LIVE_MAX_SIDE)))
+
+# Giới hạn bộ nhớ khi xử lý ảnh lớn
+PROXY_MAX_SIDE = int(os.getenv("PROXY_MAX_SIDE", "1024"))  # Cạnh dài tối đa của ảnh thu nhỏ cho mô hình và phát hiện khuôn mặt
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "1536"))  # Bộ nhớ tối đa ước tính cho mỗi request
+# Tổng dung lượng tối đa của các bộ đệm ghép ảnh được giữ lại để dùng lại (MB)
+COMPOSITING_POOL_MB = int(os.getenv("COMPOSITING_POOL_MB", "64"))
+# Bộ nhớ cho một lần chạy mô hình (tensor đầu vào và activation), nên chỉnh theo memory_peak_mb đo được
+MODEL_INFERENCE_MB = int(os.getenv("MODEL_INFERENCE_MB", "512"))
+
+# Tải mô hình ngay khi khởi động (dành cho worker xử lý ảnh).
+# Mặc định mô hình và torch chỉ được tải ở request xử lý ảnh đầu tiên.
+PRELOAD_MODEL = os.getenv("PRELOAD_MODEL", "0") == "1"
+
+# Điều phối request theo chi phí (đơn vị chi phí: xem app/admission.py)
+ADMISSION_CAPACITY = float(os.getenv("ADMISSION_CAPACITY", "8"))  # Tổng chi phí được xử lý đồng thời
+ADMISSION_MAX_QUEUE_COST = float(os.getenv("ADMISSION_MAX_QUEUE_COST", "64"))  # Tổng chi phí tối đa trong hàng đợi
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "30"))  # Thời gian chờ tối đa (giây)
+ADMISSION_PER_HOST_LIMIT = int(os.getenv("ADMISSION_PER_HOST_LIMIT", "16"))  # Số request đang xử lý/chờ của mỗi địa chỉ IP
+ADMISSION_PER_CLIENT_LIMIT = int(os.getenv("ADMISSION_PER_CLIENT_LIMIT", "4"))  # Số request đang xử lý/chờ của mỗi client (IP + X-Client-Id)
+ADMISSION_INTERACTIVE_MAX_COST = float(os.getenv("ADMISSION_INTERACTIVE_MAX_COST", "3"))  # Request lớn hơn được xếp vào hàng bulk
+ADMISSION_WEIGHTS = {"interactive": 4, "bulk": 1}  # Trọng số lấy request từ mỗi hàng đợi
+
+# Chế độ xem trước nhanh (hai bước: preview rồi finalize)
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "512"))  # Cạnh dài tối đa của ảnh đưa vào mô hình khi xem trước
+# Kích thước đầu vào của mô hình khi xem trước (mặc định mô hình phóng ảnh về 1024x1024)
+PREVIEW_MODEL_INPUT_SIZE = int(os.getenv("PREVIEW_MODEL_INPUT_SIZE", str(PREVIEW_MAX_SIDE)))
+PREVIEW_DPI = int(os.getenv("PREVIEW_DPI", "96"))  # DPI của ảnh thẻ xem trước (ảnh in dùng DPI trong app/utils.py)
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "80"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # Thời gian giữ trạng thái xem trước (giây)
+
+# Tự động hạ mức mô hình khi quá tải (xem app/model_ladder.py)
+LADDER_LATENCY_SLO = float(os.getenv("LADDER_LATENCY_SLO", "3.0"))  # Độ trễ phân đoạn mục tiêu (giây)
+LADDER_DEGRADE_DEPTH = int(os.getenv("LADDER_DEGRADE_DEPTH", "4"))  # Số request chờ/chạy phân đoạn để hạ mức
+LADDER_RECOVER_DEPTH = int(os.getenv("LADDER_RECOVER_DEPTH", "1"))  # Số request tối đa để nâng mức trở lại
+LADDER_RECOVER_RATIO = float(os.getenv("LADDER_RECOVER_RATIO", "0.6"))  # Chỉ nâng mức khi độ trễ dưới SLO x hệ số này
+LADDER_HOLD_SECONDS = float(os.getenv("LADDER_HOLD_SECONDS", "15"))  # Thời gian giữ mức tối thiểu trước khi nâng mức
+LADDER_REDUCED_INPUT_SIZE = int(os.getenv("LADDER_REDUCED_INPUT_SIZE", "512"))  # Kích thước đầu vào mức reduced
+LITE_MODEL_DIR = os.getenv("LITE_MODEL_DIR", os.path.join(BASE_DIR, "models"))  # Thư mục chứa mô hình nhẹ (U2NET_HOME)
+LITE_MODEL_NAME = os.getenv("LITE_MODEL_NAME", "u2netp")
+
+# Đo bộ nhớ theo request (chỉ bật khi cần tìm rò rỉ bộ nhớ, có chi phí hiệu năng)
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "0") == "1"
+MEMORY_PROFILING_FRAMES = int(os.getenv("MEMORY_PROFILING_FRAMES", "5"))  # Số frame lưu cho mỗi vị trí cấp phát
+MEMORY_PROFILING_HISTORY = int(os.getenv("MEMORY_PROFILING_HISTORY", "200"))  # Số request gần nhất được giữ lại
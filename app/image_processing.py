@@ -1,20 +1,116 @@
 import os
-import torch
+import sys
+import math
+import time
+import tempfile
+import threading
 from PIL import Image
-import numpy as np
-import cv2
-from transformers import pipeline
+
+from app.config import (
+    PROXY_MAX_SIDE, PREVIEW_MAX_SIDE, PREVIEW_MODEL_INPUT_SIZE, PREVIEW_DPI, PREVIEW_QUALITY,
+    LADDER_REDUCED_INPUT_SIZE, LITE_MODEL_DIR, LITE_MODEL_NAME,
+)
+from app.model_ladder import tier_selector
+from app.compositing import composite_image, composite_with_border
+
+# torch, transformers, numpy và cv2 được import khi cần (trong các hàm bên dưới)
+# để tiến trình chỉ phục vụ các endpoint nhẹ không phải tải các thư viện này
 
 # Tạo biến toàn cục cho mô hình để tránh tải lại mỗi lần gọi hàm
 bria_model = None
+lite_session = None
+
+# Thống kê lưu trữ mask và thời gian dựng lại ảnh đã xóa phông.
+# cutout_png_bytes là dung lượng thực của các ảnh nobg_* đã dựng (cùng định dạng PNG trước đây
+# luôn được ghi ra), so với cutout_mask_bytes là mask tương ứng; mask không bao giờ được dựng lại
+# thì tiết kiệm toàn bộ ảnh PNG
+storage_stats = {
+    "masks_saved": 0,
+    "mask_bytes": 0,
+    "original_bytes": 0,
+    "cutouts_reconstructed": 0,
+    "cutout_png_bytes": 0,
+    "cutout_mask_bytes": 0,
+    "reconstruct_seconds": 0.0,
+}
+
+# Bộ phát hiện khuôn mặt được tạo một lần cho mỗi thread
+# (đọc file XML mỗi lần gọi tốn thời gian, và CascadeClassifier không nên dùng chung giữa các thread)
+_face_detectors = threading.local()
 
-def remove_background(input_path, output_path):
+# Khóa theo đường dẫn để nhiều request cùng lúc chỉ dựng mỗi ảnh nobg_* một lần
+_reconstruct_locks = {}
+_reconstruct_locks_guard = threading.Lock()
+
+def get_model():
+    """Tải mô hình briaai/RMBG-1.4 (chỉ tải một lần cho mỗi tiến trình)"""
+    global bria_model
+    if bria_model is None:
+        from transformers import pipeline
+        bria_model = pipeline("image-segmentation", model="briaai/RMBG-1.4", trust_remote_code=True, device="cpu")
+    return bria_model
+
+def get_lite_session():
+    """Tải mô hình nhẹ (U2Net-p qua rembg) từ LITE_MODEL_DIR, chỉ tải một lần"""
+    global lite_session
+    if lite_session is None:
+        # rembg đọc mô hình từ thư mục U2NET_HOME
+        os.environ.setdefault("U2NET_HOME", LITE_MODEL_DIR)
+        from rembg import new_session
+        lite_session = new_session(LITE_MODEL_NAME)
+    return lite_session
+
+def open_proxy(source, max_side=PROXY_MAX_SIDE, mode='RGB'):
     """
-    Xóa phông nền của ảnh sử dụng mô hình briaai/RMBG-1.4 và lưu kết quả
+    Mở ảnh ở độ phân giải thu nhỏ (cạnh dài tối đa max_side).
+    Với JPEG, draft cho phép giải mã trực tiếp ở tỉ lệ 1/2, 1/4, 1/8 mà không cần giải mã toàn bộ ảnh.
     """
-    # Đảm bảo thư mục đầu ra tồn tại
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
+    with Image.open(source) as img:
+        img.draft(mode, (max_side, max_side))
+        if img.mode in ('RGB', 'RGBA', 'L'):
+            # Thu nhỏ trước khi đổi hệ màu, không tạo bản sao độ phân giải đầy đủ
+            img.thumbnail((max_side, max_side))
+        proxy = img.convert(mode)
+    proxy.thumbnail((max_side, max_side))
+    return proxy
+
+def segment_image(input_img, tier="full", input_size=None):
+    """
+    Chạy mô hình phân đoạn (theo mức mô hình) trên ảnh RGB và trả về mask dạng ảnh 'L'.
+    input_size: giới hạn kích thước đầu vào của RMBG (mặc định mô hình phóng ảnh về 1024x1024,
+    nên ảnh thu nhỏ chỉ rẻ hơn khi giảm cả kích thước này).
+    """
+    if tier == "reduced":
+        input_size = min(input_size or LADDER_REDUCED_INPUT_SIZE, LADDER_REDUCED_INPUT_SIZE)
+    if tier == "lite":
+        mask = get_lite_session().predict(input_img)[0]
+    elif input_size:
+        mask = get_model()(input_img, model_input_size=[input_size, input_size], return_mask=True)
+    else:
+        mask = get_model()(input_img, return_mask=True)
+    if not isinstance(mask, Image.Image):
+        mask = Image.fromarray((mask * 255).astype('uint8'))
+    if mask.mode != 'L':
+        mask = mask.convert('L')
+    return mask
+
+def segment_with_ladder(input_img, min_tier=None, input_size=None):
+    """
+    Phân đoạn với mức mô hình được chọn theo tải hiện tại, trả về (mask, mức mô hình).
+    input_size: kích thước đầu vào của mô hình (xem segment_image).
+    """
+    tier = tier_selector.acquire(min_tier)
+    started = time.perf_counter()
+    try:
+        mask = segment_image(input_img, tier, input_size)
+    finally:
+        tier_selector.release(time.perf_counter() - started)
+    if mask.size != input_img.size:
+        mask = mask.resize(input_img.size, Image.BILINEAR)
+    return mask, tier
+
+def run_segmentation(input_path, min_tier=None):
+    """Chạy mô hình xóa phông trên ảnh thu nhỏ, trả về (mask ở độ phân giải thu nhỏ, mức mô hình)"""
     try:
         # Sử dụng mô hình briaai/RMBG-1.4 để xóa phông nền
         print(f"Đang xử lý xóa phông nền với briaai/RMBG-1.4, đường dẫn ảnh: {input_path}")
@@ -23,183 +119,359 @@ def remove_background(input_path, output_path):
         if not os.path.exists(input_path):
             raise Exception(f"File không tồn tại: {input_path}")
         
-        # Tải mô hình sử dụng pipeline (giống như trong server.py)
-        global bria_model
-        if bria_model is None:
-            bria_model = pipeline("image-segmentation", model="briaai/RMBG-1.4", trust_remote_code=True, device="cpu")
-        
-        # Đọc ảnh đầu vào
-        input_img = Image.open(input_path).convert("RGB")
+        # Mô hình tự thu nhỏ ảnh về 1024px, nên chỉ cần đưa vào ảnh thu nhỏ
+        proxy_img = open_proxy(input_path)
         
         # Xử lý ảnh với mô hình
         print("Đang xóa nền ảnh...")
-        result = bria_model(input_img, return_mask=True)
-        
-        # Xử lý mask
-        mask = result
-        if not isinstance(mask, Image.Image):
-            mask = Image.fromarray((mask * 255).astype('uint8'))
-        
-        # Tạo ảnh RGBA với alpha channel từ mask
-        no_bg_image = Image.new("RGBA", input_img.size, (0, 0, 0, 0))
-        no_bg_image.paste(input_img, mask=mask)
-        
-        # Lưu ảnh kết quả
-        no_bg_image.save(output_path, format='PNG', compress_level=1)
-        print(f"Đã xử lý xong ảnh và lưu vào: {output_path}")
+        mask, tier = segment_with_ladder(proxy_img, min_tier)
+        del proxy_img
         
-        # Giải phóng bộ nhớ GPU
-        torch.cuda.empty_cache()
+        # Giải phóng bộ nhớ GPU (torch đã được tải cùng mô hình)
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            torch.cuda.empty_cache()
         
     except Exception as e:
         print(f"Lỗi khi sử dụng briaai/RMBG-1.4: {str(e)}")
         raise Exception(f"Không thể xóa nền ảnh: {str(e)}")
     
+    return mask, tier
+
+def remove_background(input_path, output_path, min_tier=None):
+    """
+    Xóa phông nền của ảnh sử dụng mô hình briaai/RMBG-1.4 và lưu kết quả.
+    Mô hình chạy trên ảnh thu nhỏ, chỉ mask được phóng to về kích thước gốc.
+    """
+    # Đảm bảo thư mục đầu ra tồn tại
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    
+    mask, _ = run_segmentation(input_path, min_tier)
+    try:
+        apply_mask(input_path, mask, output_path)
+    except Exception as e:
+        raise Exception(f"Không thể xóa nền ảnh: {str(e)}")
+    print(f"Đã xử lý xong ảnh và lưu vào: {output_path}")
+    
     return output_path
 
-def create_id_photo(input_path, output_path, size_name="3x4", bg_color=(255, 255, 255), width_px=None, height_px=None):
-    """Tạo ảnh thẻ với kích thước chuẩn và nền trắng, cắt ảnh theo tỉ lệ phù hợp"""
-    from app.utils import PHOTO_SIZES, mm_to_pixels
+def extract_mask(input_path, mask_path, min_tier=None):
+    """
+    Xóa phông nền nhưng chỉ lưu mask 1 kênh (ở độ phân giải mô hình) thay cho ảnh RGBA đầy đủ.
+    Ảnh đã xóa phông được dựng lại từ ảnh gốc và mask khi cần (reconstruct_cutout).
+    Trả về (mask_path, mức mô hình đã dùng).
+    """
+    os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+    
+    mask, tier = run_segmentation(input_path, min_tier)
+    save_mask(mask, mask_path)
+    
+    # Thống kê dung lượng mask (so sánh với ảnh PNG đã xóa phông khi ảnh được dựng lại)
+    mask_bytes = os.path.getsize(mask_path)
+    storage_stats["masks_saved"] += 1
+    storage_stats["mask_bytes"] += mask_bytes
+    storage_stats["original_bytes"] += os.path.getsize(input_path)
+    print(f"Đã lưu mask {mask_bytes / 1024:.1f} KB vào: {mask_path}")
+    
+    return mask_path, tier
+
+def save_mask(mask, mask_path):
+    """Lưu mask dạng PNG 1 bit/pixel nếu mask chỉ có 0 và 255 (viền cứng), ngược lại 8 bit"""
+    colors = mask.getcolors(2)
+    if colors is not None and all(value in (0, 255) for _, value in colors):
+        mask.convert('1', dither=Image.Dither.NONE).save(mask_path, format='PNG', optimize=True)
+    else:
+        mask.save(mask_path, format='PNG', optimize=True)
+    return mask_path
+
+def load_mask(mask_path):
+    """Đọc mask đã lưu, luôn trả về ảnh 'L'"""
+    with Image.open(mask_path) as mask:
+        return mask.convert('L')
+
+def load_cutout(input_path, mask):
+    """Dựng ảnh RGBA đã xóa phông từ ảnh gốc và mask (ảnh 'L' hoặc đường dẫn file mask)"""
+    if not isinstance(mask, Image.Image):
+        mask = load_mask(mask)
+    
+    # Đọc ảnh đầu vào ở độ phân giải đầy đủ
+    with Image.open(input_path) as src:
+        input_img = src.convert("RGB")
+    
+    if mask.size != input_img.size:
+        mask = mask.resize(input_img.size, Image.BILINEAR)
+    
+    # Gắn mask làm kênh alpha trực tiếp, không tạo thêm ảnh RGBA trung gian
+    input_img.putalpha(mask)
+    return input_img
+
+def apply_mask(input_path, mask, output_path):
+    """Gắn mask (phóng to về kích thước gốc nếu cần) làm kênh alpha cho ảnh gốc và lưu PNG"""
+    load_cutout(input_path, mask).save(output_path, format='PNG', compress_level=1)
+    return output_path
+
+def reconstruct_cutout(input_path, mask_path, output_path):
+    """
+    Dựng lại ảnh đã xóa phông (nobg_*) từ ảnh gốc và mask khi client yêu cầu.
+    Bỏ qua nếu ảnh đã được dựng bởi request khác.
+    """
+    with _reconstruct_locks_guard:
+        lock = _reconstruct_locks.setdefault(output_path, threading.Lock())
+    try:
+        with lock:
+            if os.path.exists(output_path):
+                return output_path
+            started = time.perf_counter()
+            # Ghi ra file tạm có tên riêng rồi đổi tên, tránh client khác đọc file đang ghi dở
+            # (worker khác có thể dựng cùng ảnh cùng lúc)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(output_path),
+                                             prefix=f".{os.path.basename(output_path)}.", suffix=".tmp")
+            os.close(fd)
+            try:
+                apply_mask(input_path, mask_path, temp_path)
+                os.replace(temp_path, output_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            elapsed = time.perf_counter() - started
+            storage_stats["cutouts_reconstructed"] += 1
+            storage_stats["cutout_png_bytes"] += os.path.getsize(output_path)
+            storage_stats["cutout_mask_bytes"] += os.path.getsize(mask_path)
+            storage_stats["reconstruct_seconds"] += elapsed
+            print(f"Đã dựng lại ảnh đã xóa phông trong {elapsed * 1000:.0f} ms: {output_path}")
+    finally:
+        # File đã tồn tại khi khóa bị xóa, các request đến sau sẽ bỏ qua ở bước kiểm tra trên
+        with _reconstruct_locks_guard:
+            _reconstruct_locks.pop(output_path, None)
+    return output_path
+
+def get_face_cascade():
+    """Bộ phát hiện khuôn mặt Haar Cascade của thread hiện tại"""
+    import cv2
+    
+    cascade = getattr(_face_detectors, "cascade", None)
+    if cascade is None:
+        cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        _face_detectors.cascade = cascade
+    return cascade
+
+def detect_face(img):
+    """
+    Phát hiện khuôn mặt lớn nhất trên ảnh thu nhỏ.
+    Trả về (x, y, w, h) theo tọa độ ảnh gốc, hoặc None nếu không tìm thấy.
+    """
+    try:
+        import numpy as np
+        
+        # Thu nhỏ ảnh theo hệ số nguyên trước khi chuyển sang ảnh xám
+        factor = max(1, math.ceil(max(img.size) / PROXY_MAX_SIDE))
+        proxy = img.reduce(factor) if factor > 1 else img
+        gray = np.array(proxy.convert('L'))
+        scale_x = img.width / proxy.width
+        scale_y = img.height / proxy.height
+        del proxy
+        
+        # Bộ phát hiện khuôn mặt Haar Cascade (dùng lại trong thread)
+        face_cascade = get_face_cascade()
+        
+        # Phát hiện khuôn mặt
+        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+        if len(faces) == 0:
+            return None
+        
+        # Lấy khuôn mặt lớn nhất (nếu có nhiều khuôn mặt)
+        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+        return (int(x * scale_x), int(y * scale_y), int(w * scale_x), int(h * scale_y))
+    
+    except Exception as face_error:
+        print(f"Lỗi khi xử lý khuôn mặt: {str(face_error)}")
+        return None
+
+def compute_crop_box(img_size, width_px, height_px, face=None):
+    """
+    Tính vùng cắt trên ảnh gốc (tọa độ thực) sao cho khi resize vùng này về
+    (width_px, height_px) sẽ được ảnh thẻ với khuôn mặt ở vị trí chuẩn.
+    """
+    img_width, img_height = img_size
+    
+    if face is not None:
+        x, y, face_width, face_height = face
+        
+        # Tính toán tỉ lệ khuôn mặt so với ảnh thẻ
+        # Theo tiêu chuẩn, khuôn mặt chiếm khoảng 50-60% chiều cao của ảnh thẻ
+        # để chừa không gian cho vai và phần trên đầu
+        face_ratio = 0.45  # Giảm xuống 45% để chừa không gian cho vai
+        
+        # Tính toán tỉ lệ thu phóng
+        new_face_height = int(height_px * face_ratio)
+        scale_factor = new_face_height / face_height
+        
+        # Kích thước ảnh sau khi thu phóng (không cần resize toàn bộ ảnh)
+        new_width = int(img_width * scale_factor)
+        new_height = int(img_height * scale_factor)
+        
+        # Tính toán vị trí mới của khuôn mặt sau khi thu phóng
+        new_face_left = int(x * scale_factor)
+        new_face_top = int(y * scale_factor)
+        
+        # Khuôn mặt nên cách mép trên khoảng 25% chiều cao ảnh thẻ
+        top_margin = int(height_px * 0.25)
+        
+        # Tính toán vị trí cắt ảnh
+        crop_left = max(0, new_face_left - (width_px - int(face_width * scale_factor)) // 2)
+        crop_top = max(0, new_face_top - top_margin)
+        
+        # Đảm bảo vị trí cắt không vượt quá kích thước ảnh
+        if crop_left + width_px > new_width:
+            crop_left = max(0, new_width - width_px)
+        if crop_top + height_px > new_height:
+            crop_top = max(0, new_height - height_px)
+        
+        if crop_left + width_px <= new_width and crop_top + height_px <= new_height:
+            # Đổi vùng cắt về tọa độ ảnh gốc
+            return (
+                crop_left / scale_factor,
+                crop_top / scale_factor,
+                (crop_left + width_px) / scale_factor,
+                (crop_top + height_px) / scale_factor,
+            )
+        
+        # Nếu không thể cắt đúng kích thước, resize toàn bộ ảnh để vừa với kích thước ảnh thẻ
+        return (0, 0, img_width, img_height)
+    
+    # Nếu không tìm thấy khuôn mặt, giữ tỉ lệ và căn giữa
+    img_ratio = img_width / img_height
+    id_ratio = width_px / height_px
+    
+    if img_ratio > id_ratio:
+        # Ảnh rộng hơn so với tỉ lệ ảnh thẻ
+        crop_width = img_height * id_ratio
+        left = (img_width - crop_width) / 2
+        return (left, 0, left + crop_width, img_height)
+    
+    # Ảnh cao hơn so với tỉ lệ ảnh thẻ
+    crop_height = img_width / id_ratio
+    top = (img_height - crop_height) / 4  # Lấy phần trên nhiều hơn
+    return (0, top, img_width, top + crop_height)
+
+def scale_face(face, from_size, to_size):
+    """Đổi tọa độ khuôn mặt (x, y, w, h) từ ảnh kích thước from_size sang ảnh kích thước to_size"""
+    if face is None:
+        return None
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    x, y, w, h = face
+    return (int(x * scale_x), int(y * scale_y), int(w * scale_x), int(h * scale_y))
+
+def crop_from_mask(input_path, mask, width_px, height_px, face="auto"):
+    """
+    Cắt vùng ảnh thẻ từ ảnh gốc và mask mà không dựng ảnh RGBA độ phân giải đầy đủ:
+    khuôn mặt được tìm trên ảnh thu nhỏ, vùng cắt được tính trước, rồi chỉ vùng cắt
+    của ảnh gốc và mask được resize về kích thước ảnh thẻ và gắn kênh alpha.
+    Trả về ảnh RGBA (width_px, height_px) chưa ghép nền.
+    """
+    if not isinstance(mask, Image.Image):
+        mask = load_mask(mask)
+    
+    with Image.open(input_path) as src:
+        full_size = src.size
+        if face == "auto":
+            proxy = open_proxy(input_path)
+            face = scale_face(detect_face(proxy), proxy.size, full_size)
+            proxy.close()
+        box = compute_crop_box(full_size, width_px, height_px, face)
+        
+        # JPEG: giải mã ở tỉ lệ 1/2, 1/4, 1/8 nếu vùng cắt vẫn đủ độ phân giải cho ảnh thẻ
+        scale = min((box[2] - box[0]) / width_px, (box[3] - box[1]) / height_px)
+        if scale >= 2:
+            src.draft('RGB', (math.ceil(full_size[0] / scale), math.ceil(full_size[1] / scale)))
+        if src.mode not in ('RGB', 'RGBA', 'L'):
+            src = src.convert('RGB')
+        
+        # resize với box chỉ đọc vùng cắt (cộng lề của bộ lọc LANCZOS), không sao chép ảnh gốc
+        decoded_x = src.width / full_size[0]
+        decoded_y = src.height / full_size[1]
+        decoded_box = (box[0] * decoded_x, box[1] * decoded_y, box[2] * decoded_x, box[3] * decoded_y)
+        cropped = src.resize((width_px, height_px), Image.LANCZOS, box=decoded_box)
+    
+    if cropped.mode != 'RGB':
+        cropped = cropped.convert('RGB')
+    
+    # Mask ở độ phân giải mô hình: resize thẳng vùng cắt về kích thước ảnh thẻ
+    mask_x = mask.width / full_size[0]
+    mask_y = mask.height / full_size[1]
+    mask_box = (box[0] * mask_x, box[1] * mask_y, box[2] * mask_x, box[3] * mask_y)
+    cropped.putalpha(mask.resize((width_px, height_px), Image.BILINEAR, box=mask_box))
+    return cropped
+
+def crop_id_photo(img, width_px, height_px, face="auto"):
+    """
+    Cắt ảnh RGBA đã xóa phông về kích thước (width_px, height_px) quanh khuôn mặt, chưa ghép nền.
+    face: "auto" để tự phát hiện khuôn mặt, None nếu không có khuôn mặt, hoặc (x, y, w, h) đã biết.
+    """
+    if face == "auto":
+        face = detect_face(img)
+    box = compute_crop_box(img.size, width_px, height_px, face)
+    
+    # Chỉ resize vùng cắt, không resize toàn bộ ảnh
+    return img.resize((width_px, height_px), Image.LANCZOS, box=box)
+
+def compose_id_photo(img, width_px, height_px, bg_color=(255, 255, 255), face="auto"):
+    """Ghép ảnh RGBA đã xóa phông vào nền kích thước (width_px, height_px), trả về ảnh RGB"""
+    img_cropped = crop_id_photo(img, width_px, height_px, face)
+    
+    # Trộn alpha lên màu nền trong một lần ghi (NumPy), không tạo ảnh nền trung gian
+    background = composite_image(img_cropped, bg_color)
+    img_cropped.close()
+    return background
+
+def create_id_photo(input_path, output_path, size_name="3x4", bg_color=(255, 255, 255), width_px=None, height_px=None,
+                    face="auto", mask=None, raise_errors=False, border_path=None, border_width=2, border_color=(0, 0, 0)):
+    """
+    Tạo ảnh thẻ với kích thước chuẩn và nền trắng, cắt ảnh theo tỉ lệ phù hợp.
+    Nếu có mask, input_path là ảnh gốc và ảnh đã xóa phông được dựng trong bộ nhớ.
+    border_path: đồng thời lưu ảnh có viền, ghép nền và viền trong cùng một lần.
+    raise_errors: báo lỗi thay vì ghi ảnh trống (dùng cho xử lý hàng loạt).
+    """
+    from app.utils import get_size_px
     
     try:
         if width_px is None or height_px is None:
-            # Tìm kích thước ảnh thẻ theo tên
-            size_info = next((s for s in PHOTO_SIZES if s["name"] == size_name), PHOTO_SIZES[0])
-            
-            # Chuyển đổi kích thước từ mm sang pixel
-            width_px = mm_to_pixels(size_info["width"])
-            height_px = mm_to_pixels(size_info["height"])
+            width_px, height_px = get_size_px(size_name)
         
-        # Mở ảnh đã xóa phông
-        try:
-            img = Image.open(input_path)
+        if mask is not None:
+            # Chỉ xử lý vùng cắt của ảnh gốc và mask, không dựng ảnh RGBA đầy đủ
+            cropped = crop_from_mask(input_path, mask, width_px, height_px, face)
+        else:
+            # Mở ảnh đã xóa phông
+            try:
+                # Đóng file ngay sau khi đọc, kể cả khi convert tạo ảnh mới
+                with Image.open(input_path) as src:
+                    img = src.convert('RGBA') if src.mode != 'RGBA' else src.copy()
+                    
+                # Kiểm tra kênh alpha có hợp lệ không
+                if 'A' not in img.getbands():
+                    img.close()
+                    raise Exception("Ảnh không có kênh alpha hợp lệ")
+                    
+            except Exception as img_error:
+                raise Exception(f"Lỗi khi mở ảnh đã xóa phông: {str(img_error)}")
             
-            # Đảm bảo ảnh có kênh alpha
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-                
-            # Kiểm tra kênh alpha có hợp lệ không
-            if 'A' not in img.getbands():
-                raise Exception("Ảnh không có kênh alpha hợp lệ")
-                
-        except Exception as img_error:
-            raise Exception(f"Lỗi khi mở ảnh đã xóa phông: {str(img_error)}")
-        
-        img_np = np.array(img.convert('RGB'))  # Convert to RGB for OpenCV
-        
-        # Tạo ảnh nền mới với màu nền đườỉ định
-        background = Image.new('RGBA', (width_px, height_px), bg_color + (255,))
+            # Phát hiện khuôn mặt trên ảnh thu nhỏ (nếu chưa biết) và cắt vùng ảnh thẻ
+            try:
+                cropped = crop_id_photo(img, width_px, height_px, face)
+            finally:
+                img.close()
         
+        # Trộn alpha lên màu nền (và vẽ viền) trong một lần ghi (NumPy)
         try:
-            # Chuyển đổi ảnh sang định dạng BGR cho OpenCV
-            img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-            
-            # Tải bộ phát hiện khuôn mặt Haar Cascade
-            face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-            
-            # Phát hiện khuôn mặt
-            gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-            faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-            
-            if len(faces) > 0:
-                # Lấy khuôn mặt lớn nhất (nếu có nhiều khuôn mặt)
-                face = max(faces, key=lambda x: x[2] * x[3])
-                x, y, w, h = face
-                
-                # Tính toán kích thước khuôn mặt
-                face_height = h
-                face_width = w
-                
-                # Tính toán tỉ lệ khuôn mặt so với ảnh thẻ
-                # Theo tiêu chuẩn, khuôn mặt chiếm khoảng 50-60% chiều cao của ảnh thẻ
-                # để chừa không gian cho vai và phần trên đầu
-                face_ratio = 0.45  # Giảm xuống 45% để chừa không gian cho vai
-                
-                # Tính toán kích thước mới của ảnh
-                new_face_height = int(height_px * face_ratio)
-                scale_factor = new_face_height / face_height
-                
-                # Tính toán kích thước mới của toàn bộ ảnh
-                new_width = int(img.width * scale_factor)
-                new_height = int(img.height * scale_factor)
-                
-                # Resize ảnh theo tỉ lệ mới
-                img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-                
-                # Tính toán vị trí mới của khuôn mặt sau khi resize
-                new_face_left = int(x * scale_factor)
-                new_face_top = int(y * scale_factor)
-                
-                # Tính toán vị trí để đặt khuôn mặt vào phần trên của ảnh thẻ
-                # Khuôn mặt nên cách mép trên khoảng 25% chiều cao ảnh thẻ
-                top_margin = int(height_px * 0.25)  # Đặt khuôn mặt ở vị trí 25% từ trên xuống
-                
-                # Tính toán vị trí cắt ảnh
-                crop_left = max(0, new_face_left - (width_px - int(face_width * scale_factor)) // 2)
-                crop_top = max(0, new_face_top - top_margin)
-                
-                # Đảm bảo vị trí cắt không vượt quá kích thước ảnh
-                if crop_left + width_px > new_width:
-                    crop_left = max(0, new_width - width_px)
-                if crop_top + height_px > new_height:
-                    crop_top = max(0, new_height - height_px)
-                
-                # Cắt ảnh theo kích thước ảnh thẻ
-                if crop_left + width_px <= new_width and crop_top + height_px <= new_height:
-                    img_cropped = img_resized.crop((crop_left, crop_top, crop_left + width_px, crop_top + height_px))
-                    
-                    # Ghép ảnh đã cắt vào nền
-                    background.paste(img_cropped, (0, 0), img_cropped)
-                else:
-                    # Nếu không thể cắt đúng kích thước, resize ảnh để vừa với kích thước ảnh thẻ
-                    img_resized = img.resize((width_px, height_px), Image.LANCZOS)
-                    background.paste(img_resized, (0, 0), img_resized)
-            else:
-                # Nếu không tìm thấy khuôn mặt, resize ảnh để vừa với kích thước ảnh thẻ
-                # Giữ tỉ lệ và căn giữa
-                img_ratio = img.width / img.height
-                id_ratio = width_px / height_px
-                
-                if img_ratio > id_ratio:
-                    # Ảnh rộng hơn so với tỉ lệ ảnh thẻ
-                    new_height = height_px
-                    new_width = int(new_height * img_ratio)
-                    img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-                    left = (new_width - width_px) // 2
-                    img_cropped = img_resized.crop((left, 0, left + width_px, height_px))
-                else:
-                    # Ảnh cao hơn so với tỉ lệ ảnh thẻ
-                    new_width = width_px
-                    new_height = int(new_width / img_ratio)
-                    img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-                    top = (new_height - height_px) // 4  # Lấy phần trên nhiều hơn
-                    img_cropped = img_resized.crop((0, top, width_px, top + height_px))
-                
-                background.paste(img_cropped, (0, 0), img_cropped)
-                
-        except Exception as face_error:
-            print(f"Lỗi khi xử lý khuôn mặt: {str(face_error)}")
-            # Nếu không thể xử lý khuôn mặt, resize ảnh để vừa với kích thước ảnh thẻ
-            # Giữ tỉ lệ và căn giữa
-            img_ratio = img.width / img.height
-            id_ratio = width_px / height_px
-            
-            if img_ratio > id_ratio:
-                # Ảnh rộng hơn so với tỉ lệ ảnh thẻ
-                new_height = height_px
-                new_width = int(new_height * img_ratio)
-                img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-                left = (new_width - width_px) // 2
-                img_cropped = img_resized.crop((left, 0, left + width_px, height_px))
+            if border_path is not None:
+                background, bordered = composite_with_border(cropped, bg_color, border_width, border_color)
+                bordered.save(border_path, format='PNG')
             else:
-                # Ảnh cao hơn so với tỉ lệ ảnh thẻ
-                new_width = width_px
-                new_height = int(new_width / img_ratio)
-                img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-                top = (new_height - height_px) // 4  # Lấy phần trên nhiều hơn
-                img_cropped = img_resized.crop((0, top, width_px, top + height_px))
-            
-            background.paste(img_cropped, (0, 0), img_cropped)
+                background = composite_image(cropped, bg_color)
+        finally:
+            cropped.close()
         
         # Lưu ảnh kết quả
         background.save(output_path, format='PNG')
@@ -207,23 +479,47 @@ def create_id_photo(input_path, output_path, size_name="3x4", bg_color=(255, 255
         
     except Exception as e:
         print(f"Lỗi khi tạo ảnh thẻ: {str(e)}")
+        if raise_errors:
+            raise
         # Nếu có lỗi, tạo một ảnh trống với kích thước yêu cầu
         try:
-            from app.utils import PHOTO_SIZES, mm_to_pixels
-            
             if width_px is None or height_px is None:
-                # Tìm kích thước ảnh thẻ theo tên
-                size_info = next((s for s in PHOTO_SIZES if s["name"] == size_name), PHOTO_SIZES[0])
-                
-                # Chuyển đổi kích thước từ mm sang pixel
-                width_px = mm_to_pixels(size_info["width"])
-                height_px = mm_to_pixels(size_info["height"])
+                width_px, height_px = get_size_px(size_name)
             
             # Tạo ảnh trống
             blank_image = Image.new('RGB', (width_px, height_px), bg_color)
             blank_image.save(output_path, format='PNG')
+            if border_path is not None:
+                composite_image(blank_image, border_color, border_width, border_color).save(border_path, format='PNG')
             print("Đã tạo ảnh trống do xảy ra lỗi!")
         except Exception as blank_error:
             print(f"Lỗi khi tạo ảnh trống: {str(blank_error)}")
     
-    return output_path
\ No newline at end of file
+    return output_path
+
+def create_preview(input_path, output_path, size_name="3x4", bg_color=(255, 255, 255),
+                   image_format="WEBP", max_side=PREVIEW_MAX_SIDE, dpi=PREVIEW_DPI, min_tier=None,
+                   model_input_size=PREVIEW_MODEL_INPUT_SIZE):
+    """
+    Tạo ảnh thẻ xem trước ở độ phân giải thấp, mô hình chạy với kích thước đầu vào model_input_size.
+    Trả về (mask, face, tier): mask ở độ phân giải xem trước và khuôn mặt theo tọa độ ảnh gốc,
+    dùng lại khi tạo ảnh độ phân giải in (không cần chạy lại mô hình và phát hiện khuôn mặt).
+    """
+    from app.utils import get_size_px
+    
+    with Image.open(input_path) as src:
+        full_width, full_height = src.size
+    
+    cutout = open_proxy(input_path, max_side)
+    mask, tier = segment_with_ladder(cutout, min_tier, model_input_size)
+    cutout.putalpha(mask)
+    
+    face = detect_face(cutout)
+    width_px, height_px = get_size_px(size_name, dpi)
+    preview = compose_id_photo(cutout, width_px, height_px, bg_color, face)
+    preview.save(output_path, format=image_format, quality=PREVIEW_QUALITY)
+    
+    # Đổi tọa độ khuôn mặt về ảnh gốc
+    face = scale_face(face, cutout.size, (full_width, full_height))
+    
+    return mask, face, tier
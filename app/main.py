@@ -1,9 +1,10 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
-from app.config import APP_NAME, APP_DESCRIPTION, APP_VERSION, CORS_ORIGINS, STATIC_DIR
-from app.routers import photo
+from app.config import APP_NAME, APP_DESCRIPTION, APP_VERSION, CORS_ORIGINS, STATIC_DIR, PRELOAD_MODEL
+from app import profiling
+from app.routers import photo, live, debug
+from app.static_files import CachedStaticFiles, load_result_index
 
 app = FastAPI(
     title=APP_NAME,
@@ -22,9 +23,30 @@ app.add_middleware(
 
 # Đăng ký router
 app.include_router(photo.router)
+app.include_router(live.router)
+
+# Đo bộ nhớ theo request (MEMORY_PROFILING=1), chỉ mở endpoint debug khi được bật
+if profiling.enabled():
+    profiling.start()
+    app.include_router(debug.router)
+
+    @app.middleware("http")
+    async def profile_memory(request: Request, call_next):
+        with profiling.profile_request(f"{request.method} {request.url.path}"):
+            return await call_next(request)
 
 # Mount thư mục static để phục vụ file tĩnh
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+app.mount("/static", CachedStaticFiles(directory=STATIC_DIR), name="static")
+
+# Nạp danh sách file kết quả để /preview không cần kiểm tra hệ thống file
+load_result_index()
+
+@app.on_event("startup")
+async def preload_model():
+    if PRELOAD_MODEL:
+        from fastapi.concurrency import run_in_threadpool
+        from app.image_processing import get_model
+        await run_in_threadpool(get_model)
 
 @app.get("/")
 async def root():
@@ -0,0 +1,60 @@
+from app.config import MEMORY_BUDGET_MB, MODEL_INFERENCE_MB, PROXY_MAX_SIDE
+
+MB = 1024 * 1024
+
+# Số byte trên mỗi pixel ảnh gốc tại thời điểm tốn bộ nhớ nhất khi xử lý upload:
+# ảnh gốc đã giải mã (tối đa RGBA, 4 byte). Mô hình chạy trên ảnh thu nhỏ và ảnh thẻ
+# chỉ resize vùng cắt của ảnh gốc và mask, không dựng ảnh RGBA độ phân giải đầy đủ.
+FULL_RES_BYTES_PER_PIXEL = 4
+
+# Ghép ảnh thẻ/viền bằng NumPy (app/compositing.py), trên mỗi pixel ảnh đầu ra: ảnh RGBA đã giải mã (4)
+# + các kênh tách ra (4) + 3 bộ đệm uint16 (6) + bộ đệm đầu ra (3) + ảnh RGB sau merge (3)
+COMPOSITE_BYTES_PER_PIXEL = 20
+
+# Dựng lại ảnh đã xóa phông (nobg_*) khi client truy cập: ảnh RGB (3) + mask phóng to (1)
+# + ảnh RGBA sau putalpha (4)
+CUTOUT_BYTES_PER_PIXEL = 8
+
+class MemoryBudgetExceeded(Exception):
+    """Ước tính bộ nhớ cần dùng vượt quá giới hạn cho phép"""
+
+def estimate_peak_bytes(width, height, id_width_px, id_height_px, border_width=0,
+                        sheet_rows=0, sheet_cols=0, sheet_spacing=0, include_model=True):
+    """
+    Ước tính bộ nhớ tối đa (byte) cần để xử lý một ảnh kích thước width x height.
+    include_model: cộng bộ nhớ chạy mô hình trên ảnh thu nhỏ (MODEL_INFERENCE_MB).
+    """
+    # Các bước xử lý chạy tuần tự nên lấy bước tốn bộ nhớ nhất
+    full_res = width * height * FULL_RES_BYTES_PER_PIXEL
+    proxy_side = min(max(width, height), PROXY_MAX_SIDE)
+    proxy = proxy_side * proxy_side * 4
+    # Mô hình chạy trên ảnh thu nhỏ sau khi giải mã (ảnh gốc đã được giải phóng)
+    model = proxy + MODEL_INFERENCE_MB * MB if include_model and width and height else 0
+
+    # Ảnh thẻ và ảnh có viền được ghép trong một lần (bộ đệm theo kích thước có viền)
+    id_photo = id_width_px * id_height_px * COMPOSITE_BYTES_PER_PIXEL
+    tile_width = id_width_px + 2 * border_width
+    tile_height = id_height_px + 2 * border_width
+    border = tile_width * tile_height * COMPOSITE_BYTES_PER_PIXEL if border_width else 0
+
+    # Tờ ảnh RGB chứa rows x cols ảnh thẻ
+    sheet = 0
+    if sheet_rows and sheet_cols:
+        sheet_width = sheet_cols * tile_width + (sheet_cols + 1) * sheet_spacing
+        sheet_height = sheet_rows * tile_height + (sheet_rows + 1) * sheet_spacing
+        sheet = sheet_width * sheet_height * 3 + tile_width * tile_height * 4
+
+    return max(full_res + proxy, model, id_photo, border, sheet)
+
+def estimate_cutout_bytes(width, height):
+    """Ước tính bộ nhớ (byte) để dựng lại ảnh đã xóa phông kích thước width x height"""
+    return width * height * CUTOUT_BYTES_PER_PIXEL
+
+def check_memory_budget(estimated_bytes, budget_mb=MEMORY_BUDGET_MB):
+    """Báo lỗi nếu ước tính bộ nhớ vượt giới hạn, trả về số MB ước tính"""
+    estimated_mb = estimated_bytes / MB
+    if estimated_mb > budget_mb:
+        raise MemoryBudgetExceeded(
+            f"Ảnh quá lớn: cần khoảng {estimated_mb:.0f} MB, giới hạn {budget_mb} MB"
+        )
+    return estimated_mb
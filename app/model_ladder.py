@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+from app.admission import admission
+from app.config import (
+    LADDER_LATENCY_SLO, LADDER_DEGRADE_DEPTH, LADDER_RECOVER_DEPTH, LADDER_HOLD_SECONDS,
+    LADDER_RECOVER_RATIO, LITE_MODEL_DIR, LITE_MODEL_NAME,
+)
+
+# Các mức mô hình, theo thứ tự chất lượng giảm dần:
+# - full: RMBG-1.4 với kích thước đầu vào mặc định (1024)
+# - reduced: RMBG-1.4 với kích thước đầu vào giảm (LADDER_REDUCED_INPUT_SIZE)
+# - lite: mô hình nhẹ lớp U2Net-p (rembg) tải từ LITE_MODEL_DIR
+TIERS = ["full", "reduced", "lite"]
+
+# Hệ số làm mượt cho độ trễ trung bình (EWMA)
+LATENCY_SMOOTHING = 0.2
+
+# Khoảng cách tối thiểu giữa hai lần hạ mức, tránh nhảy thẳng xuống mức thấp nhất
+DEGRADE_MIN_INTERVAL = 1.0
+
+def lite_model_available():
+    """Mô hình nhẹ chỉ được dùng khi file mô hình đã có sẵn (không tải từ mạng khi quá tải)"""
+    return os.path.exists(os.path.join(LITE_MODEL_DIR, f"{LITE_MODEL_NAME}.onnx"))
+
+class TierSelector:
+    """
+    Chọn mức mô hình theo số request đang chờ/chạy phân đoạn và độ trễ so với SLO.
+    Có trễ (hysteresis): hạ mức ngay khi quá tải, nhưng chỉ nâng mức khi tải đã giảm
+    và mức hiện tại đã được giữ ít nhất LADDER_HOLD_SECONDS giây.
+    backlog: hàm trả về số request đang chờ trước bước phân đoạn (hàng đợi của bộ điều phối),
+    được cộng vào số request đang phân đoạn khi đánh giá tải.
+    """
+
+    def __init__(self, backlog=None):
+        self.lock = threading.Lock()
+        self.backlog = backlog
+        self.tiers = TIERS if lite_model_available() else TIERS[:-1]
+        self.level = 0
+        self.depth = 0
+        self.latency = 0.0
+        self.last_switch = time.monotonic()
+        self.switches = 0
+        self.counts = {tier: 0 for tier in TIERS}
+
+    def acquire(self, min_tier=None):
+        """Bắt đầu một lần phân đoạn, trả về mức mô hình được chọn"""
+        with self.lock:
+            self.depth += 1
+            self._adjust()
+            level = self.level
+            if min_tier in self.tiers:
+                # Client yêu cầu chất lượng tối thiểu
+                level = min(level, self.tiers.index(min_tier))
+            tier = self.tiers[level]
+            self.counts[tier] += 1
+            return tier
+
+    def release(self, seconds):
+        """Kết thúc một lần phân đoạn, cập nhật độ trễ trung bình"""
+        with self.lock:
+            self.depth -= 1
+            if self.latency == 0.0:
+                self.latency = seconds
+            else:
+                self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+            self._adjust()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "tier": self.tiers[self.level],
+                "available_tiers": list(self.tiers),
+                "depth": self.depth,
+                "backlog": self._backlog(),
+                "latency_ewma_seconds": round(self.latency, 3),
+                "latency_slo_seconds": LADDER_LATENCY_SLO,
+                "switches": self.switches,
+                "requests_by_tier": dict(self.counts),
+            }
+
+    def _backlog(self):
+        return self.backlog() if self.backlog is not None else 0
+
+    def _adjust(self):
+        now = time.monotonic()
+        # Request bị giữ trong hàng đợi của bộ điều phối chưa đến bước phân đoạn, nhưng vẫn là tải
+        load = self.depth + self._backlog()
+        overloaded = load >= LADDER_DEGRADE_DEPTH or self.latency > LADDER_LATENCY_SLO
+        relaxed = (
+            load <= LADDER_RECOVER_DEPTH
+            and self.latency < LADDER_LATENCY_SLO * LADDER_RECOVER_RATIO
+            and now - self.last_switch >= LADDER_HOLD_SECONDS
+        )
+        if overloaded and self.level < len(self.tiers) - 1 and now - self.last_switch >= DEGRADE_MIN_INTERVAL:
+            self._switch(self.level + 1, now)
+        elif relaxed and self.level > 0:
+            self._switch(self.level - 1, now)
+
+    def _switch(self, level, now):
+        print(f"Chuyển mức mô hình: {self.tiers[self.level]} -> {self.tiers[level]} "
+              f"(đang phân đoạn: {self.depth}, đang chờ: {self._backlog()}, độ trễ: {self.latency:.2f}s)")
+        self.level = level
+        self.last_switch = now
+        self.switches += 1
+
+# Bộ chọn mức mô hình dùng chung cho tiến trình, tính cả hàng đợi của bộ điều phối
+tier_selector = TierSelector(backlog=admission.queue_length)
@@ -7,6 +7,16 @@ class PhotoResponse(BaseModel):
     id_photo_url: Optional[str] = None
     id_photo_with_border_url: Optional[str] = None  # URL ảnh thẻ có viền
     photo_sheet_url: Optional[str] = None  # URL sheet ảnh thẻ
+    memory_estimate_mb: Optional[float] = None  # Bộ nhớ tối đa ước tính trước khi xử lý (MB), dùng để giới hạn request
+    memory_peak_mb: Optional[float] = None  # Mức tăng RSS cao nhất đo được trong khi xử lý (MB)
+    model_tier: Optional[str] = None  # Mức mô hình đã dùng để xóa phông (full, reduced, lite)
+    message: str
+
+class PreviewResponse(BaseModel):
+    session_id: str  # Dùng cho /finalize/{session_id}
+    original_url: str
+    preview_url: str  # Ảnh thẻ xem trước độ phân giải thấp (WebP/JPEG)
+    model_tier: Optional[str] = None
     message: str
 
 class PhotoSize(BaseModel):
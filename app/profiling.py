@@ -0,0 +1,150 @@
+"""
+Đo bộ nhớ theo từng request và từng bước xử lý (bật bằng MEMORY_PROFILING=1).
+
+Lưu ý: tracemalloc chỉ thấy các cấp phát qua Python/NumPy, bộ nhớ ảnh của Pillow
+chỉ thể hiện qua RSS. Đỉnh tracemalloc là giá trị toàn tiến trình nên khi nhiều
+request chạy đồng thời, số liệu của từng request có thể lẫn vào nhau.
+"""
+import contextvars
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+from app.config import MEMORY_PROFILING, MEMORY_PROFILING_FRAMES, MEMORY_PROFILING_HISTORY
+
+MB = 1024 * 1024
+
+# Bản ghi của request hiện tại (được sao chép sang threadpool cùng context)
+_current_record = contextvars.ContextVar("memory_profile_record", default=None)
+
+# Các request gần nhất
+recent_records = deque(maxlen=MEMORY_PROFILING_HISTORY)
+
+def enabled():
+    return MEMORY_PROFILING
+
+def start():
+    """Bắt đầu theo dõi cấp phát bộ nhớ"""
+    if MEMORY_PROFILING and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_PROFILING_FRAMES)
+
+def rss_bytes():
+    """Bộ nhớ RSS hiện tại của tiến trình (byte)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Không phải Linux: dùng RSS tối đa (macOS trả về byte, Linux trả về KB)
+        import resource
+        import sys
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+@contextmanager
+def track_peak_rss(interval=0.02):
+    """
+    Đo mức RSS cao nhất (so với lúc bắt đầu) trong khối lệnh bằng một thread lấy mẫu RSS,
+    luôn bật (không cần MEMORY_PROFILING). Kết quả (MB) nằm trong result["peak_mb"].
+    RSS là của toàn tiến trình nên khi nhiều request chạy đồng thời, số đo có thể lớn hơn
+    bộ nhớ thực của request; các đỉnh ngắn hơn interval có thể bị bỏ sót.
+    """
+    baseline = rss_bytes()
+    result = {"peak_mb": 0.0}
+    peak = [baseline]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak[0] = max(peak[0], rss_bytes())
+
+    sampler = threading.Thread(target=sample, name="rss-sampler", daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        sampler.join()
+        peak[0] = max(peak[0], rss_bytes())
+        result["peak_mb"] = round((peak[0] - baseline) / MB, 1)
+
+def _measure_start(record=None):
+    if record is not None:
+        # reset_peak làm mất đỉnh trước đó, giữ lại đỉnh lớn nhất của request
+        _fold_peak(record)
+    tracemalloc.reset_peak()
+    return rss_bytes(), tracemalloc.get_traced_memory()[0], time.perf_counter()
+
+def _measure_end(started, peak=None):
+    rss_before, traced_before, time_before = started
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    if peak is not None:
+        traced_peak = max(traced_peak, peak)
+    return {
+        "seconds": round(time.perf_counter() - time_before, 3),
+        "tracemalloc_peak_mb": round((traced_peak - traced_before) / MB, 2),
+        "rss_delta_mb": round((rss_bytes() - rss_before) / MB, 2),
+    }
+
+def _fold_peak(record):
+    record["_peak"] = max(record["_peak"], tracemalloc.get_traced_memory()[1])
+
+@contextmanager
+def profile_request(name):
+    """Đo bộ nhớ cho toàn bộ request"""
+    if not MEMORY_PROFILING:
+        yield None
+        return
+    record = {"request": name, "stages": {}, "_peak": 0}
+    token = _current_record.set(record)
+    started = _measure_start()
+    try:
+        yield record
+    finally:
+        _current_record.reset(token)
+        record.update(_measure_end(started, record.pop("_peak")))
+        recent_records.append(record)
+
+@contextmanager
+def profile_stage(name):
+    """Đo bộ nhớ cho một bước xử lý trong request hiện tại"""
+    record = _current_record.get()
+    if record is None:
+        yield
+        return
+    started = _measure_start(record)
+    try:
+        yield
+    finally:
+        _fold_peak(record)
+        record["stages"][name] = _measure_end(started)
+
+def top_allocations(limit=20, group_by="lineno"):
+    """Các vị trí cấp phát bộ nhớ nhiều nhất hiện tại"""
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    return [
+        {
+            "location": str(stat.traceback[0]),
+            "size_mb": round(stat.size / MB, 3),
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics(group_by)[:limit]
+    ]
+
+def report(limit=20):
+    traced_now, traced_peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+    return {
+        "enabled": MEMORY_PROFILING,
+        "rss_mb": round(rss_bytes() / MB, 2),
+        "tracemalloc_current_mb": round(traced_now / MB, 2),
+        "tracemalloc_peak_mb": round(traced_peak / MB, 2),
+        "top_allocations": top_allocations(limit),
+        "recent_requests": list(recent_records),
+    }
@@ -0,0 +1,16 @@
+from fastapi import APIRouter, Query
+
+from app import profiling
+
+router = APIRouter(
+    prefix="/api/debug",
+    tags=["debug"],
+)
+
+@router.get("/memory")
+async def memory_report(limit: int = Query(20, ge=1, le=200)):
+    """
+    Báo cáo bộ nhớ: RSS, các vị trí cấp phát nhiều nhất (tracemalloc)
+    và số liệu theo từng bước của các request gần nhất
+    """
+    return profiling.report(limit)
@@ -0,0 +1,213 @@
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image, ImageChops, ImageStat
+import asyncio
+import io
+import json
+import os
+import time
+
+from app.config import LIVE_MAX_SIDE, LIVE_MODEL_INPUT_SIZE, LIVE_TARGET_FPS, LIVE_DIFF_THRESHOLD, LIVE_JPEG_QUALITY
+from app.utils import generate_unique_filename, get_mask_filename, get_size_px, parse_color
+from app.static_files import register_result
+from app.admission import admission, estimate_cost
+from app.image_processing import open_proxy, segment_with_ladder, extract_mask, create_id_photo
+from app.routers.photo import read_image_size, check_upload_memory, admit
+
+router = APIRouter(
+    prefix="/api/photo",
+    tags=["live"],
+)
+
+# Kích thước ảnh thu nhỏ dùng để so sánh hai khung hình liên tiếp
+DIFF_SIZE = (64, 48)
+
+def frame_difference(frame_a, frame_b):
+    """Độ chênh lệch trung bình (0-255) giữa hai khung hình đã thu nhỏ"""
+    diff = ImageChops.difference(frame_a, frame_b)
+    return ImageStat.Stat(diff).mean[0]
+
+def encode_output(frame, mask, output_mode, bg_color):
+    """Nén mask (PNG) hoặc ảnh đã ghép nền (JPEG) để gửi về client"""
+    buffer = io.BytesIO()
+    if output_mode == "mask":
+        mask.save(buffer, format='PNG', compress_level=1)
+    else:
+        composite = Image.new('RGB', frame.size, bg_color)
+        composite.paste(frame, mask=mask)
+        composite.save(buffer, format='JPEG', quality=LIVE_JPEG_QUALITY)
+    return buffer.getvalue()
+
+def process_frame(data, state, output_mode, bg_color):
+    """Xử lý một khung hình: dùng lại mask cũ nếu khung hình gần như không đổi"""
+    frame = open_proxy(io.BytesIO(data), LIVE_MAX_SIDE)
+    thumb = frame.convert('L').resize(DIFF_SIZE)
+
+    prev_mask = state.get("mask")
+    reuse = (
+        prev_mask is not None
+        and prev_mask.size == frame.size
+        and frame_difference(thumb, state["thumb"]) < LIVE_DIFF_THRESHOLD
+    )
+    if reuse:
+        mask = prev_mask
+        state["reused"] += 1
+    else:
+        # Giảm cả kích thước đầu vào của mô hình, không chỉ kích thước khung hình.
+        # Đi qua bộ chọn mức mô hình để khung hình được tính vào tải và độ trễ
+        mask, _ = segment_with_ladder(frame, input_size=LIVE_MODEL_INPUT_SIZE)
+        state["mask"] = mask
+        state["thumb"] = thumb
+        state["segmented"] += 1
+
+    return encode_output(frame, mask, output_mode, bg_color)
+
+def process_capture(data, size, bg_color):
+    """Ảnh chụp cuối cùng chất lượng đầy đủ: đi qua luồng xử lý ảnh thẻ hiện có"""
+    filename = generate_unique_filename("capture.jpg")
+    original_path = os.path.join("static", "uploads", filename)
+    mask_path = os.path.join("static", "results", get_mask_filename(filename))
+    id_photo_path = os.path.join("static", "results", f"idphoto_{filename}")
+
+    with open(original_path, "wb") as buffer:
+        buffer.write(data)
+
+    _, tier = extract_mask(original_path, mask_path)
+    register_result(mask_path)
+    create_id_photo(original_path, id_photo_path, size, bg_color, mask=mask_path)
+    register_result(id_photo_path)
+
+    base_url = "/static"
+    return {
+        "type": "capture",
+        "original_url": f"{base_url}/uploads/{filename}",
+        "removed_bg_url": f"{base_url}/results/nobg_{filename}",
+        "id_photo_url": f"{base_url}/results/idphoto_{filename}",
+        "model_tier": tier,
+    }
+
+@router.websocket("/live")
+async def live_preview(
+    websocket: WebSocket,
+    output: str = "composite",
+    bg_color: str = "255,255,255",
+    fps: float = LIVE_TARGET_FPS
+):
+    """
+    Xem trước trực tiếp qua WebSocket:
+    - Client gửi các khung hình JPEG dạng binary
+    - Server trả về mask (PNG, output=mask) hoặc ảnh đã ghép nền (JPEG, output=composite)
+    - Khung hình đến khi server còn bận sẽ bị bỏ qua, chỉ xử lý khung hình mới nhất
+    - Gửi text {"action": "capture", "size": "3x4"} rồi một khung hình binary
+      chất lượng đầy đủ để tạo ảnh thẻ (qua cùng giới hạn bộ nhớ và điều phối như /upload)
+    """
+    await websocket.accept()
+
+    bg_color_tuple = parse_color(bg_color, (255, 255, 255))
+    frame_interval = 1.0 / fps if fps and fps > 0 else 0.0
+
+    latest = {"data": None, "dropped": 0}
+    frame_ready = asyncio.Event()
+    capture_request = None
+    closed = False
+    # Giữ tham chiếu đến các task capture để không bị thu hồi khi đang chạy
+    capture_tasks = set()
+
+    async def receive_frames():
+        nonlocal capture_request, closed
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+
+                if message.get("text") is not None:
+                    try:
+                        command = json.loads(message["text"])
+                    except ValueError:
+                        continue
+                    if command.get("action") == "capture":
+                        capture_request = command
+                    continue
+
+                data = message.get("bytes")
+                if not data:
+                    continue
+
+                if capture_request is not None:
+                    # Khung hình ngay sau lệnh capture là ảnh chụp chất lượng đầy đủ
+                    command, capture_request = capture_request, None
+                    task = asyncio.create_task(send_capture(data, command))
+                    capture_tasks.add(task)
+                    task.add_done_callback(capture_tasks.discard)
+                    continue
+
+                # Ghi đè khung hình cũ chưa xử lý thay vì xếp hàng
+                if latest["data"] is not None:
+                    latest["dropped"] += 1
+                latest["data"] = data
+                frame_ready.set()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            closed = True
+            frame_ready.set()
+
+    async def send_capture(data, command):
+        ticket = None
+        try:
+            size = command.get("size", "3x4")
+            src_width, src_height = read_image_size(io.BytesIO(data))
+            check_upload_memory(src_width, src_height, size, False, 0, False, 0, 0, 0)
+            id_width_px, id_height_px = get_size_px(size)
+            cost = estimate_cost(src_width, src_height, id_width_px, id_height_px)
+            ticket = await admit(websocket, websocket.headers.get("x-client-id"),
+                                 websocket.headers.get("x-priority"), cost)
+            result = await run_in_threadpool(process_capture, data, size, bg_color_tuple)
+            await websocket.send_text(json.dumps(result))
+        except HTTPException as e:
+            if not closed:
+                await websocket.send_text(json.dumps({"type": "error", "status_code": e.status_code,
+                                                      "detail": e.detail}))
+        except Exception as e:
+            if not closed:
+                await websocket.send_text(json.dumps({"type": "error", "detail": f"Lỗi xử lý ảnh: {str(e)}"}))
+        finally:
+            if ticket is not None:
+                admission.release(ticket)
+
+    receiver = asyncio.create_task(receive_frames())
+    state = {"mask": None, "thumb": None, "reused": 0, "segmented": 0}
+
+    try:
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            if closed:
+                break
+
+            data, latest["data"] = latest["data"], None
+            if data is None:
+                continue
+
+            started = time.perf_counter()
+            try:
+                payload = await run_in_threadpool(process_frame, data, state, output, bg_color_tuple)
+            except Exception as e:
+                print(f"Lỗi khi xử lý khung hình: {str(e)}")
+                continue
+            await websocket.send_bytes(payload)
+
+            # Giới hạn tốc độ khung hình trả về theo fps mục tiêu
+            elapsed = time.perf_counter() - started
+            if elapsed < frame_interval:
+                await asyncio.sleep(frame_interval - elapsed)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        # Chờ các ảnh chụp đang xử lý kết thúc để trả lại quyền xử lý (admission)
+        if capture_tasks:
+            await asyncio.gather(*capture_tasks, return_exceptions=True)
+        print(f"Kết thúc xem trước trực tiếp: {state['segmented']} khung hình phân đoạn, "
+              f"{state['reused']} khung hình dùng lại mask, {latest['dropped']} khung hình bị bỏ qua")
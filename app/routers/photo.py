@@ -1,14 +1,26 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from typing import Optional
+from contextvars import copy_context
 import os
 import shutil
+import tempfile
 from pathlib import Path
+from PIL import Image
 
-from app.models import PhotoResponse, PhotoSize, PhotoSizeResponse
-from app.utils import generate_unique_filename, PHOTO_SIZES
-from app.image_processing import remove_background, create_id_photo
+from app.config import PREVIEW_DPI, PREVIEW_MAX_SIDE
+from app.models import PhotoResponse, PhotoSize, PhotoSizeResponse, PreviewResponse
+from app.utils import generate_unique_filename, get_size_px, get_mask_filename, parse_color, PHOTO_SIZES
+from app.memory import estimate_peak_bytes, check_memory_budget, MemoryBudgetExceeded
+from app.static_files import register_result, result_exists, materialize_cutout, cutout_sources
+from app.admission import admission, estimate_cost, classify, AdmissionRejected
+from app.model_ladder import tier_selector, TIERS
+from app.sessions import new_session_id, save_session, load_session
+from app.image_processing import extract_mask, run_segmentation, save_mask, create_id_photo, create_preview, storage_stats
 from app.image_utils import add_border_to_photo, create_photo_sheet
+from app.profiling import profile_stage, track_peak_rss
+from app.compositing import buffer_pool
 
 router = APIRouter(
     prefix="/api/photo",
@@ -22,8 +34,268 @@ async def get_photo_sizes():
     sizes = [PhotoSize(**size) for size in PHOTO_SIZES]
     return {"sizes": sizes}
 
+@router.get("/metrics")
+async def get_metrics():
+    """Số liệu điều phối request (admission control), mức mô hình, lưu trữ mask và bộ đệm ghép ảnh"""
+    return {
+        "admission": admission.metrics(),
+        "model": tier_selector.metrics(),
+        "storage": storage_stats,
+        "compositing": buffer_pool.metrics(),
+    }
+
+def read_image_size(stream):
+    """Chỉ đọc header để lấy kích thước ảnh, không giải mã toàn bộ ảnh"""
+    try:
+        with Image.open(stream) as header:
+            return header.size
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Ảnh quá lớn")
+    except Exception:
+        raise HTTPException(status_code=400, detail="File ảnh không hợp lệ")
+    finally:
+        stream.seek(0)
+
+def check_upload_memory(src_width, src_height, size, border_enabled, border_width,
+                        sheet_enabled, sheet_rows, sheet_cols, sheet_spacing, include_model=True):
+    """Ước tính bộ nhớ trước khi giải mã, trả về số MB ước tính (413 nếu vượt giới hạn)"""
+    id_width_px, id_height_px = get_size_px(size)
+    estimated_bytes = estimate_peak_bytes(
+        src_width, src_height, id_width_px, id_height_px,
+        border_width=border_width if border_enabled else 0,
+        sheet_rows=sheet_rows if sheet_enabled else 0,
+        sheet_cols=sheet_cols if sheet_enabled else 0,
+        sheet_spacing=sheet_spacing, include_model=include_model,
+    )
+    try:
+        memory_estimate_mb = check_memory_budget(estimated_bytes)
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    print(f"Ảnh {src_width}x{src_height}, bộ nhớ ước tính: {memory_estimate_mb:.1f} MB")
+    return memory_estimate_mb
+
+def read_result_size(input_path):
+    """
+    Đọc kích thước ảnh đầu vào của /add-border và /create-sheet từ header.
+    Ảnh nobg_* chưa được dựng thì đọc từ ảnh gốc. Trả về (width, height, cần dựng lại).
+    """
+    if os.path.exists(input_path):
+        source_path, missing = input_path, False
+    else:
+        sources = cutout_sources(os.path.basename(input_path))
+        if sources is None or not all(os.path.exists(path) for path in sources):
+            raise HTTPException(status_code=404, detail="File không tồn tại")
+        source_path, missing = sources[0], True
+    with open(source_path, "rb") as f:
+        width, height = read_image_size(f)
+    return width, height, missing
+
+def check_result_memory(width, height, border_width=0, sheet_rows=0, sheet_cols=0, sheet_spacing=0):
+    """Ước tính bộ nhớ cho /add-border và /create-sheet từ kích thước ảnh đầu vào (413 nếu vượt giới hạn)"""
+    estimated_bytes = estimate_peak_bytes(
+        0, 0, width, height, border_width=border_width,
+        sheet_rows=sheet_rows, sheet_cols=sheet_cols, sheet_spacing=sheet_spacing, include_model=False,
+    )
+    try:
+        check_memory_budget(estimated_bytes)
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+def ensure_result_file(input_path):
+    """Dựng ảnh nobg_* nếu chưa có (404 nếu không tồn tại, 413 nếu vượt giới hạn bộ nhớ)"""
+    if os.path.exists(input_path):
+        return
+    try:
+        materialized = materialize_cutout(os.path.basename(input_path))
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not materialized:
+        raise HTTPException(status_code=404, detail="File không tồn tại")
+
+def check_layout(border_enabled, border_width, sheet_enabled, sheet_rows, sheet_cols, sheet_spacing):
+    """Kiểm tra tham số viền và sheet (400 nếu không hợp lệ)"""
+    if border_enabled and border_width < 0:
+        raise HTTPException(status_code=400, detail="Độ rộng viền không được âm")
+    if sheet_enabled and (sheet_rows < 1 or sheet_cols < 1 or sheet_spacing < 0):
+        raise HTTPException(status_code=400, detail="Số hàng, số cột phải lớn hơn 0")
+
+def check_min_tier(min_tier):
+    if min_tier is not None and min_tier not in TIERS:
+        raise HTTPException(status_code=400, detail=f"min_tier phải là một trong: {', '.join(TIERS)}")
+
+async def admit(request, x_client_id, x_priority, cost):
+    """
+    Chờ đến lượt xử lý theo chi phí, trả về ticket (429/503 nếu bị từ chối).
+    Giới hạn theo địa chỉ IP của kết nối; X-Client-Id chỉ phân biệt các client sau cùng một IP.
+    """
+    host = request.client.host if request.client else "unknown"
+    try:
+        return await admission.acquire(host, cost, classify(cost, x_priority), client_id=x_client_id)
+    except AdmissionRejected as e:
+        headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=headers)
+
+def save_original(file):
+    """Lưu file gốc với tên duy nhất, trả về (filename, original_path)"""
+    filename = generate_unique_filename(file.filename)
+    original_path = os.path.join("static", "uploads", filename)
+    with open(original_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    return filename, original_path
+
+def build_id_photos(filename, original_path, mask, size, bg_color_tuple, border_enabled, border_width, border_color,
+                    sheet_enabled, sheet_rows, sheet_cols, sheet_spacing, face="auto", output_name=None):
+    """
+    Tạo ảnh thẻ, ảnh có viền và sheet từ ảnh gốc và mask (ảnh 'L' hoặc đường dẫn file mask), trả về dict kết quả.
+    Ảnh đã xóa phông (nobg_*) không được ghi ra, chỉ được dựng khi client truy cập removed_bg_url.
+    output_name: tên dùng cho idphoto_/border_/sheet_* (mặc định là filename).
+    """
+    output_name = output_name or filename
+    id_photo_path = os.path.join("static", "results", f"idphoto_{output_name}")
+    id_photo_with_border_path = os.path.join("static", "results", f"border_{output_name}")
+    photo_sheet_path = os.path.join("static", "results", f"sheet_{output_name}")
+    
+    # Tạo ảnh thẻ; nếu cần viền thì ảnh có viền được ghép cùng lúc (không giải mã lại ảnh thẻ đã lưu)
+    border_path = id_photo_with_border_path if border_enabled else None
+    with profile_stage("id_photo"):
+        create_id_photo(original_path, id_photo_path, size, bg_color_tuple, face=face, mask=mask,
+                        border_path=border_path, border_width=border_width,
+                        border_color=parse_color(border_color, (0, 0, 0)))
+    register_result(id_photo_path)
+    
+    # Tạo URL cho các ảnh
+    base_url = "/static"
+    original_url = f"{base_url}/uploads/{filename}"
+    removed_bg_url = f"{base_url}/results/nobg_{filename}"
+    id_photo_url = f"{base_url}/results/idphoto_{output_name}"
+    id_photo_with_border_url = None
+    photo_sheet_url = None
+    
+    # Ảnh có viền đã được tạo cùng ảnh thẻ
+    if border_enabled:
+        register_result(id_photo_with_border_path)
+        id_photo_with_border_url = f"{base_url}/results/border_{output_name}"
+        
+        # Sử dụng ảnh có viền cho sheet nếu cả hai được yêu cầu
+        sheet_input_path = id_photo_with_border_path
+    else:
+        sheet_input_path = id_photo_path
+    
+    # Tạo sheet ảnh thẻ nếu được yêu cầu
+    if sheet_enabled:
+        with profile_stage("sheet"):
+            create_photo_sheet(sheet_input_path, photo_sheet_path, sheet_rows, sheet_cols, sheet_spacing, bg_color_tuple)
+        register_result(photo_sheet_path)
+        photo_sheet_url = f"{base_url}/results/sheet_{output_name}"
+    
+    return {
+        "original_url": original_url,
+        "removed_bg_url": removed_bg_url,
+        "id_photo_url": id_photo_url,
+        "id_photo_with_border_url": id_photo_with_border_url,
+        "photo_sheet_url": photo_sheet_url,
+        "message": "Xử lý ảnh thành công"
+    }
+
+def process_upload(file, size, bg_color, border_enabled, border_width, border_color,
+                   sheet_enabled, sheet_rows, sheet_cols, sheet_spacing, min_tier=None):
+    """Chạy toàn bộ luồng xử lý ảnh (hàm đồng bộ, chạy trong threadpool)"""
+    filename, original_path = save_original(file)
+    
+    # Xóa phông nền, chỉ lưu mask
+    mask_path = os.path.join("static", "results", get_mask_filename(filename))
+    with profile_stage("segmentation"):
+        _, tier = extract_mask(original_path, mask_path, min_tier)
+    register_result(mask_path)
+    
+    result = build_id_photos(
+        filename, original_path, mask_path, size, parse_color(bg_color, (255, 255, 255)),
+        border_enabled, border_width, border_color, sheet_enabled, sheet_rows, sheet_cols, sheet_spacing,
+    )
+    result["model_tier"] = tier
+    return result
+
+def process_preview(file, src_width, src_height, size, bg_color, preview_format, min_tier=None):
+    """Xem trước: xóa phông và tạo ảnh thẻ ở độ phân giải thấp, lưu trạng thái để finalize"""
+    filename, original_path = save_original(file)
+    session_id = new_session_id()
+    
+    extension = "webp" if preview_format == "webp" else "jpg"
+    preview_path = os.path.join("static", "results", f"preview_{session_id}.{extension}")
+    bg_color_tuple = parse_color(bg_color, (255, 255, 255))
+    
+    with profile_stage("preview"):
+        mask, face, tier = create_preview(original_path, preview_path, size, bg_color_tuple,
+                                          image_format="WEBP" if extension == "webp" else "JPEG", min_tier=min_tier)
+    register_result(preview_path)
+    
+    save_session(session_id, {
+        "filename": filename,
+        "size": size,
+        "bg_color": bg_color,
+        "face": face,
+        "model_tier": tier,
+        "width": src_width,
+        "height": src_height,
+    }, mask)
+    
+    return {
+        "session_id": session_id,
+        "original_url": f"/static/uploads/{filename}",
+        "preview_url": f"/static/results/preview_{session_id}.{extension}",
+        "model_tier": tier,
+        "message": "Tạo ảnh xem trước thành công"
+    }
+
+def save_mask_once(mask, mask_path):
+    """
+    Lưu mask nếu chưa có: ảnh nobg_* dựng từ mask này được cache immutable nên mask không được ghi đè.
+    Ghi vào file tạm rồi đổi tên để request khác không đọc phải file đang ghi dở.
+    """
+    if os.path.exists(mask_path):
+        return
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(mask_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        save_mask(mask, temp_path)
+        if not os.path.exists(mask_path):
+            os.replace(temp_path, mask_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    register_result(mask_path)
+
+def process_finalize(state, mask, size, bg_color, border_enabled, border_width, border_color,
+                     sheet_enabled, sheet_rows, sheet_cols, sheet_spacing, refine=False, min_tier=None):
+    """
+    Tạo ảnh độ phân giải in từ trạng thái xem trước, dùng lại vị trí khuôn mặt.
+    Mặc định dùng lại mask xem trước (PREVIEW_MAX_SIDE): không chạy lại mô hình nhưng viền tóc/vai
+    mềm hơn khi phóng to; refine=True chạy lại mô hình trên ảnh thu nhỏ PROXY_MAX_SIDE như /upload.
+    """
+    filename = state["filename"]
+    original_path = os.path.join("static", "uploads", filename)
+    
+    tier = state.get("model_tier")
+    if refine:
+        with profile_stage("segmentation"):
+            mask, tier = run_segmentation(original_path, min_tier)
+    
+    mask_path = os.path.join("static", "results", get_mask_filename(filename))
+    save_mask_once(mask, mask_path)
+    
+    # Mỗi lần finalize tạo file mới: file tĩnh được cache immutable nên không được ghi đè
+    face = tuple(state["face"]) if state["face"] is not None else None
+    result = build_id_photos(
+        filename, original_path, mask, size, parse_color(bg_color, (255, 255, 255)),
+        border_enabled, border_width, border_color, sheet_enabled, sheet_rows, sheet_cols, sheet_spacing,
+        face=face, output_name=generate_unique_filename(filename),
+    )
+    result["model_tier"] = tier
+    return result
+
 @router.post("/upload", response_model=PhotoResponse)
 async def upload_photo(
+    request: Request,
     file: UploadFile = File(...),
     size: Optional[str] = Form("3x4"),
     bg_color: Optional[str] = Form("255,255,255"),
@@ -33,7 +305,10 @@ async def upload_photo(
     sheet_enabled: Optional[bool] = Form(False),
     sheet_rows: Optional[int] = Form(4),
     sheet_cols: Optional[int] = Form(6),
-    sheet_spacing: Optional[int] = Form(10)
+    sheet_spacing: Optional[int] = Form(10),
+    min_tier: Optional[str] = Form(None),
+    x_client_id: Optional[str] = Header(None),
+    x_priority: Optional[str] = Header(None)
 ):
     """
     Upload ảnh và xử lý:
@@ -42,95 +317,188 @@ async def upload_photo(
     3. Tạo ảnh thẻ với kích thước chuẩn
     4. Thêm viền (nếu được yêu cầu)
     5. Tạo sheet ảnh thẻ (nếu được yêu cầu)
+    
+    min_tier: mức mô hình tối thiểu chấp nhận được (full, reduced, lite) khi server quá tải
     """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File phải là ảnh")
+    check_min_tier(min_tier)
+    check_layout(border_enabled, border_width, sheet_enabled, sheet_rows, sheet_cols, sheet_spacing)
+    
+    src_width, src_height = read_image_size(file.file)
+    memory_estimate_mb = check_upload_memory(
+        src_width, src_height, size, border_enabled, border_width,
+        sheet_enabled, sheet_rows, sheet_cols, sheet_spacing,
+    )
+    
+    # Ước tính chi phí và chờ đến lượt xử lý
+    id_width_px, id_height_px = get_size_px(size)
+    cost = estimate_cost(
+        src_width, src_height, id_width_px, id_height_px,
+        border_enabled=border_enabled, border_width=border_width,
+        sheet_enabled=sheet_enabled, sheet_rows=sheet_rows, sheet_cols=sheet_cols,
+    )
+    ticket = await admit(request, x_client_id, x_priority, cost)
     
     try:
-        # Tạo tên file duy nhất
-        filename = generate_unique_filename(file.filename)
-        
-        # Đường dẫn lưu file
-        original_path = os.path.join("static", "uploads", filename)
-        removed_bg_path = os.path.join("static", "results", f"nobg_{filename}")
-        id_photo_path = os.path.join("static", "results", f"idphoto_{filename}")
-        id_photo_with_border_path = os.path.join("static", "results", f"border_{filename}")
-        photo_sheet_path = os.path.join("static", "results", f"sheet_{filename}")
-        
-        # Lưu file gốc
-        with open(original_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Xóa phông nền
-        remove_background(original_path, removed_bg_path)
-        
-        # Chuyển đổi bg_color từ chuỗi sang tuple
-        try:
-            bg_color_tuple = tuple(map(int, bg_color.split(',')))
-            if len(bg_color_tuple) != 3:
-                bg_color_tuple = (255, 255, 255)
-        except:
-            bg_color_tuple = (255, 255, 255)
-        
-        # Tạo ảnh thẻ
-        create_id_photo(removed_bg_path, id_photo_path, size, bg_color_tuple)
-        
-        # Tạo URL cho các ảnh
-        base_url = "/static"
-        original_url = f"{base_url}/uploads/{filename}"
-        removed_bg_url = f"{base_url}/results/nobg_{filename}"
-        id_photo_url = f"{base_url}/results/idphoto_{filename}"
-        id_photo_with_border_url = None
-        photo_sheet_url = None
-        
-        # Thêm viền nếu được yêu cầu
-        if border_enabled:
-            try:
-                border_color_tuple = tuple(map(int, border_color.split(',')))
-                if len(border_color_tuple) != 3:
-                    border_color_tuple = (0, 0, 0)
-            except:
-                border_color_tuple = (0, 0, 0)
-            
-            add_border_to_photo(id_photo_path, id_photo_with_border_path, border_width, border_color_tuple)
-            id_photo_with_border_url = f"{base_url}/results/border_{filename}"
-            
-            # Sử dụng ảnh có viền cho sheet nếu cả hai được yêu cầu
-            sheet_input_path = id_photo_with_border_path
-        else:
-            sheet_input_path = id_photo_path
-        
-        # Tạo sheet ảnh thẻ nếu được yêu cầu
-        if sheet_enabled:
-            create_photo_sheet(sheet_input_path, photo_sheet_path, sheet_rows, sheet_cols, sheet_spacing, bg_color_tuple)
-            photo_sheet_url = f"{base_url}/results/sheet_{filename}"
-        
-        return {
-            "original_url": original_url,
-            "removed_bg_url": removed_bg_url,
-            "id_photo_url": id_photo_url,
-            "id_photo_with_border_url": id_photo_with_border_url,
-            "photo_sheet_url": photo_sheet_url,
-            "message": "Xử lý ảnh thành công"
-        }
+        # Sao chép context để các bước trong threadpool ghi vào bản ghi đo bộ nhớ của request
+        with track_peak_rss() as peak:
+            result = await run_in_threadpool(
+                copy_context().run, process_upload, file, size, bg_color, border_enabled, border_width, border_color,
+                sheet_enabled, sheet_rows, sheet_cols, sheet_spacing, min_tier,
+            )
+        result["memory_estimate_mb"] = round(memory_estimate_mb, 1)
+        result["memory_peak_mb"] = peak["peak_mb"]
+        return result
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi xử lý ảnh: {str(e)}")
+    finally:
+        admission.release(ticket)
+
+@router.post("/preview", response_model=PreviewResponse)
+async def preview_upload(
+    request: Request,
+    file: UploadFile = File(...),
+    size: Optional[str] = Form("3x4"),
+    bg_color: Optional[str] = Form("255,255,255"),
+    preview_format: Optional[str] = Form("webp"),
+    min_tier: Optional[str] = Form(None),
+    x_client_id: Optional[str] = Header(None),
+    x_priority: Optional[str] = Header(None)
+):
+    """
+    Xem trước nhanh:
+    1. Lưu ảnh gốc
+    2. Xóa phông nền và tạo ảnh thẻ ở độ phân giải thấp (WebP/JPEG)
+    3. Lưu mask và vị trí khuôn mặt để /finalize/{session_id} tạo ảnh in
+    """
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File phải là ảnh")
+    check_min_tier(min_tier)
+    
+    src_width, src_height = read_image_size(file.file)
+    # Ảnh không phải JPEG được giải mã đầy đủ trước khi thu nhỏ nên vẫn cần giới hạn bộ nhớ như /upload
+    check_upload_memory(src_width, src_height, size, False, 0, False, 0, 0, 0)
+    preview_width, preview_height = get_size_px(size, PREVIEW_DPI)
+    scale = min(1.0, PREVIEW_MAX_SIDE / max(src_width, src_height))
+    cost = estimate_cost(int(src_width * scale), int(src_height * scale), preview_width, preview_height)
+    ticket = await admit(request, x_client_id, x_priority, cost)
+    
+    try:
+        return await run_in_threadpool(copy_context().run, process_preview, file, src_width, src_height, size, bg_color, preview_format, min_tier)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi xử lý ảnh: {str(e)}")
+    finally:
+        admission.release(ticket)
+
+@router.post("/finalize/{session_id}", response_model=PhotoResponse)
+async def finalize_photo(
+    request: Request,
+    session_id: str,
+    size: Optional[str] = Form(None),
+    bg_color: Optional[str] = Form(None),
+    border_enabled: Optional[bool] = Form(False),
+    border_width: Optional[int] = Form(2),
+    border_color: Optional[str] = Form("0,0,0"),
+    sheet_enabled: Optional[bool] = Form(False),
+    sheet_rows: Optional[int] = Form(4),
+    sheet_cols: Optional[int] = Form(6),
+    sheet_spacing: Optional[int] = Form(10),
+    refine: Optional[bool] = Form(False),
+    min_tier: Optional[str] = Form(None),
+    x_client_id: Optional[str] = Header(None),
+    x_priority: Optional[str] = Header(None)
+):
+    """
+    Tạo ảnh độ phân giải in từ phiên xem trước.
+    size và bg_color mặc định lấy từ lúc xem trước.
+    Mặc định dùng lại mask xem trước (không chạy lại mô hình xóa phông);
+    refine=true chạy lại mô hình ở độ phân giải như /upload để viền sắc nét hơn.
+    """
+    check_min_tier(min_tier)
+    check_layout(border_enabled, border_width, sheet_enabled, sheet_rows, sheet_cols, sheet_spacing)
+    # Đọc JSON và giải mã mask trong threadpool, không chặn event loop
+    session = await run_in_threadpool(load_session, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Phiên xem trước không tồn tại hoặc đã hết hạn")
+    state, mask = session
+    size = size or state["size"]
+    bg_color = bg_color or state["bg_color"]
+    
+    src_width, src_height = state["width"], state["height"]
+    memory_estimate_mb = check_upload_memory(
+        src_width, src_height, size, border_enabled, border_width,
+        sheet_enabled, sheet_rows, sheet_cols, sheet_spacing, include_model=refine,
+    )
+    id_width_px, id_height_px = get_size_px(size)
+    cost = estimate_cost(
+        src_width, src_height, id_width_px, id_height_px,
+        border_enabled=border_enabled, border_width=border_width,
+        sheet_enabled=sheet_enabled, sheet_rows=sheet_rows, sheet_cols=sheet_cols,
+        include_model=refine,
+    )
+    ticket = await admit(request, x_client_id, x_priority, cost)
     
+    try:
+        with track_peak_rss() as peak:
+            result = await run_in_threadpool(
+                copy_context().run, process_finalize, state, mask, size, bg_color, border_enabled, border_width, border_color,
+                sheet_enabled, sheet_rows, sheet_cols, sheet_spacing, refine, min_tier,
+            )
+        result["memory_estimate_mb"] = round(memory_estimate_mb, 1)
+        result["memory_peak_mb"] = peak["peak_mb"]
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi xử lý ảnh: {str(e)}")
+    finally:
+        admission.release(ticket)
 
 @router.get("/preview/{filename}")
 async def preview_photo(filename: str):
     """Xem trước ảnh đã xử lý"""
-    file_path = os.path.join("static", "results", filename)
-    if not os.path.exists(file_path):
+    if not result_exists(filename):
         raise HTTPException(status_code=404, detail="Ảnh không tồn tại")
     
     return {"url": f"/static/results/{filename}"}
 
+def resolve_static_path(file_path):
+    """Chuyển URL /static/... thành đường dẫn file (400 nếu không hợp lệ)"""
+    if not file_path.startswith("/static/"):
+        raise HTTPException(status_code=400, detail="Đường dẫn file không hợp lệ")
+    relative_path = file_path.replace("/static/", "")
+    return os.path.join("static", relative_path)
+
+def process_add_border(input_path, border_width, border_color_tuple):
+    """Thêm viền cho ảnh (hàm đồng bộ, chạy trong threadpool), trả về tên file kết quả"""
+    ensure_result_file(input_path)
+    filename = os.path.basename(input_path)
+    # Tên mới cho mỗi lần gọi: file tĩnh được cache immutable nên không được ghi đè
+    output_filename = f"border_{generate_unique_filename(filename)}"
+    output_path = os.path.join("static", "results", output_filename)
+    add_border_to_photo(input_path, output_path, border_width, border_color_tuple)
+    register_result(output_path)
+    return output_filename
+
+def process_create_sheet(input_path, rows, cols, spacing, bg_color_tuple):
+    """Tạo sheet ảnh thẻ (hàm đồng bộ, chạy trong threadpool), trả về tên file kết quả"""
+    ensure_result_file(input_path)
+    filename = os.path.basename(input_path)
+    # Tên mới cho mỗi lần gọi: file tĩnh được cache immutable nên không được ghi đè
+    output_filename = f"sheet_{generate_unique_filename(filename)}"
+    output_path = os.path.join("static", "results", output_filename)
+    create_photo_sheet(input_path, output_path, rows, cols, spacing, bg_color_tuple)
+    register_result(output_path)
+    return output_filename
+
 @router.post("/add-border", response_model=PhotoResponse)
 async def add_border(
+    request: Request,
     file_path: str = Form(...),
     border_width: Optional[int] = Form(2),
-    border_color: Optional[str] = Form("0,0,0")
+    border_color: Optional[str] = Form("0,0,0"),
+    x_client_id: Optional[str] = Header(None),
+    x_priority: Optional[str] = Header(None)
 ):
     """
     Thêm viền cho ảnh thẻ:
@@ -138,33 +506,32 @@ async def add_border(
     2. Thêm viền với độ rộng và màu chỉ định
     3. Trả về URL ảnh có viền
     """
+    # Kiểm tra đường dẫn file và đọc kích thước ảnh từ header
+    input_path = resolve_static_path(file_path)
+    check_layout(True, border_width, False, 0, 0, 0)
+    width, height, missing = await run_in_threadpool(read_result_size, input_path)
+    check_result_memory(width, height, border_width=border_width)
+    
+    # Chuyển đổi border_color từ chuỗi sang tuple
     try:
-        # Kiểm tra đường dẫn file
-        if not file_path.startswith("/static/"):
-            raise HTTPException(status_code=400, detail="Đường dẫn file không hợp lệ")
-            
-        # Chuyển đổi đường dẫn tương đối thành đường dẫn tuyệt đối
-        relative_path = file_path.replace("/static/", "")
-        input_path = os.path.join("static", relative_path)
-        
-        if not os.path.exists(input_path):
-            raise HTTPException(status_code=404, detail="File không tồn tại")
-        
-        # Tạo tên file đầu ra
-        filename = os.path.basename(input_path)
-        output_filename = f"border_{filename}"
-        output_path = os.path.join("static", "results", output_filename)
-        
-        # Chuyển đổi border_color từ chuỗi sang tuple
-        try:
-            border_color_tuple = tuple(map(int, border_color.split(',')))
-            if len(border_color_tuple) != 3:
-                border_color_tuple = (0, 0, 0)
-        except:
+        border_color_tuple = tuple(map(int, border_color.split(',')))
+        if len(border_color_tuple) != 3:
             border_color_tuple = (0, 0, 0)
-        
+    except:
+        border_color_tuple = (0, 0, 0)
+    
+    # Chờ đến lượt xử lý: chi phí gồm việc dựng lại ảnh nobg_* (nếu cần) và ảnh có viền
+    cost = estimate_cost(
+        width if missing else 0, height if missing else 0, width, height,
+        border_enabled=True, border_width=border_width, include_model=False,
+    )
+    ticket = await admit(request, x_client_id, x_priority, cost)
+    
+    try:
         # Thêm viền cho ảnh
-        add_border_to_photo(input_path, output_path, border_width, border_color_tuple)
+        output_filename = await run_in_threadpool(
+            copy_context().run, process_add_border, input_path, border_width, border_color_tuple,
+        )
         
         # Xác định các URL
         base_url = "/static"
@@ -180,16 +547,23 @@ async def add_border(
             "message": "Thêm viền cho ảnh thành công"
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi khi thêm viền: {str(e)}")
+    finally:
+        admission.release(ticket)
 
 @router.post("/create-sheet", response_model=PhotoResponse)
 async def create_sheet(
+    request: Request,
     file_path: str = Form(...),
     rows: Optional[int] = Form(4),
     cols: Optional[int] = Form(6),
     spacing: Optional[int] = Form(10),
-    bg_color: Optional[str] = Form("255,255,255")
+    bg_color: Optional[str] = Form("255,255,255"),
+    x_client_id: Optional[str] = Header(None),
+    x_priority: Optional[str] = Header(None)
 ):
     """
     Tạo sheet ảnh thẻ:
@@ -197,33 +571,33 @@ async def create_sheet(
     2. Tạo sheet với số hàng, số cột và khoảng cách chỉ định
     3. Trả về URL sheet ảnh thẻ
     """
+    # Kiểm tra đường dẫn file và đọc kích thước ảnh từ header
+    input_path = resolve_static_path(file_path)
+    check_layout(False, 0, True, rows, cols, spacing)
+    width, height, missing = await run_in_threadpool(read_result_size, input_path)
+    # rows x cols do client chọn: giới hạn theo bộ nhớ ước tính của tờ ảnh
+    check_result_memory(width, height, sheet_rows=rows, sheet_cols=cols, sheet_spacing=spacing)
+    
+    # Chuyển đổi bg_color từ chuỗi sang tuple
     try:
-        # Kiểm tra đường dẫn file
-        if not file_path.startswith("/static/"):
-            raise HTTPException(status_code=400, detail="Đường dẫn file không hợp lệ")
-            
-        # Chuyển đổi đường dẫn tương đối thành đường dẫn tuyệt đối
-        relative_path = file_path.replace("/static/", "")
-        input_path = os.path.join("static", relative_path)
-        
-        if not os.path.exists(input_path):
-            raise HTTPException(status_code=404, detail="File không tồn tại")
-        
-        # Tạo tên file đầu ra
-        filename = os.path.basename(input_path)
-        output_filename = f"sheet_{filename}"
-        output_path = os.path.join("static", "results", output_filename)
-        
-        # Chuyển đổi bg_color từ chuỗi sang tuple
-        try:
-            bg_color_tuple = tuple(map(int, bg_color.split(',')))
-            if len(bg_color_tuple) != 3:
-                bg_color_tuple = (255, 255, 255)
-        except:
+        bg_color_tuple = tuple(map(int, bg_color.split(',')))
+        if len(bg_color_tuple) != 3:
             bg_color_tuple = (255, 255, 255)
-        
+    except:
+        bg_color_tuple = (255, 255, 255)
+    
+    # Chờ đến lượt xử lý: chi phí tỉ lệ với rows x cols
+    cost = estimate_cost(
+        width if missing else 0, height if missing else 0, width, height,
+        sheet_enabled=True, sheet_rows=rows, sheet_cols=cols, include_model=False,
+    )
+    ticket = await admit(request, x_client_id, x_priority, cost)
+    
+    try:
         # Tạo sheet ảnh thẻ
-        create_photo_sheet(input_path, output_path, rows, cols, spacing, bg_color_tuple)
+        output_filename = await run_in_threadpool(
+            copy_context().run, process_create_sheet, input_path, rows, cols, spacing, bg_color_tuple,
+        )
         
         # Xác định các URL
         base_url = "/static"
@@ -239,5 +613,9 @@ async def create_sheet(
             "message": "Tạo sheet ảnh thẻ thành công"
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Lỗi khi tạo sheet ảnh thẻ: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Lỗi khi tạo sheet ảnh thẻ: {str(e)}")
+    finally:
+        admission.release(ticket)
@@ -0,0 +1,65 @@
+import json
+import os
+import time
+import uuid
+
+from app.config import SESSIONS_DIR, SESSION_TTL
+from app.image_processing import save_mask, load_mask
+
+# Thời điểm dọn dẹp gần nhất, tránh quét thư mục ở mỗi request
+_last_cleanup = 0.0
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+def _session_paths(session_id):
+    # Chỉ chấp nhận UUID để tránh truy cập file ngoài thư mục sessions
+    session_id = uuid.UUID(session_id).hex
+    base = os.path.join(SESSIONS_DIR, session_id)
+    return f"{base}.json", f"{base}_mask.png"
+
+def save_session(session_id, state, mask):
+    """Lưu trạng thái xem trước (JSON) và mask độ phân giải thấp"""
+    state_path, mask_path = _session_paths(session_id)
+    save_mask(mask, mask_path)
+    state = dict(state, created_at=time.time())
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    cleanup_sessions()
+
+def load_session(session_id):
+    """Đọc trạng thái xem trước, trả về (state, mask) hoặc None nếu không tồn tại/đã hết hạn"""
+    try:
+        state_path, mask_path = _session_paths(session_id)
+    except ValueError:
+        return None
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if time.time() - state["created_at"] > SESSION_TTL:
+        delete_session(session_id)
+        return None
+    return state, load_mask(mask_path)
+
+def delete_session(session_id):
+    for path in _session_paths(session_id):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def cleanup_sessions():
+    """Xóa các trạng thái xem trước đã hết hạn (tối đa mỗi phút một lần)"""
+    global _last_cleanup
+    now = time.time()
+    if now - _last_cleanup < 60:
+        return
+    _last_cleanup = now
+    for name in os.listdir(SESSIONS_DIR):
+        path = os.path.join(SESSIONS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > SESSION_TTL:
+                os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,259 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from app.config import RESULTS_DIR, UPLOADS_DIR, STATIC_CACHE_MAX_AGE, STATIC_PRECOMPRESS
+from app.utils import get_mask_filename
+from app.memory import check_memory_budget, estimate_cutout_bytes, MemoryBudgetExceeded
+
+CHUNK_SIZE = 64 * 1024
+
+# Các biến thể nén sẵn, theo thứ tự ưu tiên
+PRECOMPRESSED_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# Danh sách tên file trong thư mục kết quả, tránh gọi os.path.exists cho mỗi request
+_result_index = set()
+
+# ETag theo nội dung đã tính: đường dẫn thật (realpath) -> ((mtime, kích thước), etag).
+# register_result nhận đường dẫn tương đối "static/results/...", còn StaticFiles dùng đường dẫn tuyệt đối
+# nên khóa phải được chuẩn hóa
+ETAG_CACHE_SIZE = 4096
+_etag_cache = OrderedDict()
+_etag_lock = threading.Lock()
+
+def content_etag(path, stat_result=None):
+    """
+    ETag mạnh tính từ nội dung file (được cache theo mtime và kích thước).
+    Đọc toàn bộ file nên chỉ gọi ngoài event loop (threadpool, lúc ghi file kết quả).
+    """
+    if stat_result is None:
+        stat_result = os.stat(path)
+    etag = cached_etag(path, stat_result)
+    if etag is not None:
+        return etag
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    etag = f'"{sha.hexdigest()[:32]}"'
+    key = os.path.realpath(path)
+    with _etag_lock:
+        _etag_cache[key] = ((stat_result.st_mtime_ns, stat_result.st_size), etag)
+        _etag_cache.move_to_end(key)
+        if len(_etag_cache) > ETAG_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+    return etag
+
+def cached_etag(path, stat_result):
+    """ETag theo nội dung nếu đã được tính cho đúng phiên bản file này, ngược lại None"""
+    key = os.path.realpath(path)
+    with _etag_lock:
+        entry = _etag_cache.get(key)
+    if entry is None or entry[0] != (stat_result.st_mtime_ns, stat_result.st_size):
+        return None
+    return entry[1]
+
+def stat_etag(stat_result):
+    """ETag rẻ từ inode, mtime và kích thước cho file chưa có ETag theo nội dung (ví dụ ảnh gốc)"""
+    return f'"{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def load_result_index():
+    """Nạp danh sách file kết quả hiện có vào bộ nhớ"""
+    _result_index.clear()
+    if os.path.isdir(RESULTS_DIR):
+        _result_index.update(os.listdir(RESULTS_DIR))
+
+def register_result(path):
+    """Ghi nhận file kết quả mới: thêm vào danh sách, tính trước ETag và tạo bản nén nếu được bật"""
+    _result_index.add(os.path.basename(path))
+    content_etag(path)
+    if STATIC_PRECOMPRESS:
+        precompress(path)
+    return path
+
+def result_exists(filename):
+    """Kiểm tra file kết quả có tồn tại (chỉ gọi hệ thống file khi chưa có trong danh sách)"""
+    if filename in _result_index:
+        return True
+    # Ảnh đã xóa phông chưa được dựng nhưng đã có mask
+    sources = cutout_sources(filename)
+    if sources is not None and os.path.basename(sources[1]) in _result_index:
+        return True
+    # File có thể được tạo bởi worker khác
+    if os.path.exists(os.path.join(RESULTS_DIR, filename)):
+        _result_index.add(filename)
+        return True
+    return False
+
+def cutout_sources(filename):
+    """Với file nobg_<ảnh gốc>, trả về (đường dẫn ảnh gốc, đường dẫn mask), ngược lại None"""
+    if not filename.startswith("nobg_"):
+        return None
+    original_filename = filename[len("nobg_"):]
+    return (
+        os.path.join(UPLOADS_DIR, original_filename),
+        os.path.join(RESULTS_DIR, get_mask_filename(original_filename)),
+    )
+
+def materialize_cutout(filename):
+    """
+    Dựng ảnh nobg_* từ ảnh gốc và mask nếu có, trả về True nếu đã dựng.
+    Báo MemoryBudgetExceeded nếu ảnh RGBA đầy đủ vượt giới hạn bộ nhớ.
+    """
+    from PIL import Image
+    from app.image_processing import reconstruct_cutout
+
+    sources = cutout_sources(filename)
+    if sources is None:
+        return False
+    original_path, mask_path = sources
+    if not (os.path.exists(original_path) and os.path.exists(mask_path)):
+        return False
+    with Image.open(original_path) as header:
+        check_memory_budget(estimate_cutout_bytes(*header.size))
+    output_path = os.path.join(RESULTS_DIR, filename)
+    reconstruct_cutout(original_path, mask_path, output_path)
+    register_result(output_path)
+    return True
+
+def precompress(path):
+    """Tạo bản nén gzip bên cạnh file, chỉ giữ lại nếu nhỏ hơn đáng kể"""
+    with open(path, "rb") as f:
+        data = f.read()
+    compressed = gzip.compress(data, compresslevel=9)
+    if len(compressed) < len(data) * 0.9:
+        with open(path + ".gz", "wb") as f:
+            f.write(compressed)
+
+def parse_range(range_header, file_size):
+    """
+    Đọc header Range dạng "bytes=start-end" (chỉ hỗ trợ một khoảng).
+    Trả về (start, end) bao gồm cả end, None nếu không hợp lệ/không hỗ trợ,
+    hoặc False nếu khoảng không thỏa mãn được.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    start, _, end = ranges.strip().partition("-")
+    try:
+        if start == "":
+            # Dạng "bytes=-N": N byte cuối cùng
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, file_size - length), file_size - 1
+        start = int(start)
+        end = int(end) if end else file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size or start > end:
+        return False
+    return start, min(end, file_size - 1)
+
+def iter_file_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles cho các file kết quả bất biến (mỗi lần ghi dùng tên file UUID mới):
+    - ETag mạnh theo nội dung (hoặc theo inode/mtime/kích thước nếu chưa tính sẵn)
+      và Cache-Control: immutable
+    - If-None-Match trả về 304
+    - Range trả về 206
+    - Phục vụ bản nén sẵn (.br, .gz) nếu client hỗ trợ
+    - Dựng ảnh đã xóa phông (nobg_*) từ mask ở lần truy cập đầu tiên
+    """
+
+    async def get_response(self, path, scope):
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as exc:
+            directory, filename = os.path.split(os.path.normpath(path))
+            if exc.status_code != 404 or directory != "results":
+                raise
+            try:
+                materialized = await run_in_threadpool(materialize_cutout, filename)
+            except MemoryBudgetExceeded as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            if not materialized:
+                raise
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        method = scope["method"]
+        request_headers = Headers(scope=scope)
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+        range_header = request_headers.get("range") if method == "GET" else None
+
+        # Bản nén sẵn chỉ dùng cho response đầy đủ (không có Range)
+        variant = None
+        if not range_header:
+            accept_encoding = request_headers.get("accept-encoding", "")
+            for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+                if encoding not in accept_encoding:
+                    continue
+                try:
+                    variant = (encoding, full_path + suffix, os.stat(full_path + suffix))
+                    break
+                except OSError:
+                    continue
+
+        # Không đọc file trên event loop: ETag theo nội dung chỉ dùng khi đã được tính sẵn
+        etag = cached_etag(full_path, stat_result) or stat_etag(stat_result)
+        if variant is not None:
+            # Mỗi biểu diễn cần ETag riêng
+            etag = f'{etag[:-1]}-{variant[0]}"'
+
+        headers = {
+            "etag": etag,
+            "cache-control": f"public, max-age={STATIC_CACHE_MAX_AGE}, immutable",
+            "accept-ranges": "bytes",
+            "vary": "Accept-Encoding",
+        }
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            if "*" in tags or etag in tags or f"W/{etag}" in tags:
+                return Response(status_code=304, headers=headers)
+
+        if_range = request_headers.get("if-range")
+        if range_header and (if_range is None or if_range == etag):
+            byte_range = parse_range(range_header, stat_result.st_size)
+            if byte_range is False:
+                headers["content-range"] = f"bytes */{stat_result.st_size}"
+                return Response(status_code=416, headers=headers)
+            if byte_range is not None:
+                start, end = byte_range
+                headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+                headers["content-length"] = str(end - start + 1)
+                return StreamingResponse(
+                    iter_file_range(full_path, start, end),
+                    status_code=206, headers=headers, media_type=media_type,
+                )
+
+        if variant is not None:
+            encoding, variant_path, variant_stat = variant
+            headers["content-encoding"] = encoding
+            return FileResponse(variant_path, status_code=status_code, headers=headers,
+                                media_type=media_type, stat_result=variant_stat, method=method)
+
+        return FileResponse(full_path, status_code=status_code, headers=headers,
+                            media_type=media_type, stat_result=stat_result, method=method)
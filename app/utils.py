@@ -17,6 +17,11 @@ def mm_to_pixels(mm, dpi=DPI):
     """Chuyển đổi từ mm sang pixel dựa trên DPI"""
     return int((mm / 25.4) * dpi)
 
+def get_size_px(size_name, dpi=DPI):
+    """Lấy kích thước ảnh thẻ (pixel) theo tên, mặc định là kích thước đầu tiên"""
+    size_info = next((s for s in PHOTO_SIZES if s["name"] == size_name), PHOTO_SIZES[0])
+    return mm_to_pixels(size_info["width"], dpi), mm_to_pixels(size_info["height"], dpi)
+
 def generate_unique_filename(original_filename):
     """Tạo tên file duy nhất bằng cách thêm UUID vào tên file gốc"""
     # Lấy phần mở rộng của file
@@ -26,6 +31,21 @@ def generate_unique_filename(original_filename):
     # Kết hợp UUID với phần mở rộng
     return f"{unique_id}{ext}"
 
+def parse_color(value, default):
+    """Chuyển chuỗi màu dạng "R,G,B" sang tuple, trả về giá trị mặc định nếu không hợp lệ"""
+    try:
+        color = tuple(map(int, value.split(',')))
+        if len(color) != 3:
+            return default
+        return color
+    except Exception:
+        return default
+
+def get_mask_filename(filename):
+    """Tên file mask (PNG 1 kênh) tương ứng với file ảnh gốc"""
+    stem, _ = os.path.splitext(filename)
+    return f"mask_{stem}.png"
+
 # Tạo biến toàn cục cho mô hình để tránh tải lại mỗi lần gọi hàm
 bria_model = None
 